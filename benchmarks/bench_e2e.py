@@ -0,0 +1,252 @@
+import os, sys, shutil
+import argparse
+import contextlib
+import json
+import random
+import tempfile
+import time
+
+#run from anywhere, booktree modules live one folder up
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import httpx
+import booktree
+import goodreads
+import search
+import myx_args
+import myx_audible
+import myx_authors
+import myx_catalog
+import myx_library
+import myx_mam
+import myx_perf
+import myx_utilities
+from standins import StandIns
+
+#End to end throughput of buildTreeFromHybridSources on a synthetic library, against local service stand-ins
+words = ["shadow", "crown", "ember", "river", "storm", "glass", "iron", "winter", "throne", "wolf", "star", "ash",
+         "silver", "night", "blood", "dawn", "stone", "sea", "fire", "oath", "ghost", "garden", "queen", "moon"]
+firstNames = ["Anna", "Brandon", "Carla", "Dennis", "Elena", "Frank", "Grace", "Hugo", "Iris", "James", "Kara", "Liam"]
+lastNames = ["Abbott", "Baxter", "Cole", "Dunn", "Ellis", "Fisher", "Grant", "Hale", "Irwin", "Jensen", "Keller", "Lowe"]
+
+#MPEG-1 Layer III, 128kbps, 44.1kHz, mono: 417 byte frames of silence
+mpegFrame = b"\xff\xfb\x90\xc0" + bytes(413)
+
+def id3Frame(frameId, text):
+    #ID3v2.4 text frame, UTF-8
+    data = b"\x03" + text.encode("utf-8")
+    return frameId.encode("ascii") + syncsafe(len(data)) + b"\x00\x00" + data
+
+def syncsafe(n):
+    return bytes([(n >> 21) & 0x7f, (n >> 14) & 0x7f, (n >> 7) & 0x7f, n & 0x7f])
+
+def writeStub(path, tags, frames):
+    #an ID3 tagged MPEG stream; .m4b stubs carry the same payload, ffprobe goes by content
+    body = b""
+    for frameId, value in tags:
+        if frameId == "TXXX":
+            body += id3Frame("TXXX", f"{value[0]}\x00{value[1]}")
+        else:
+            body += id3Frame(frameId, value)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"ID3\x04\x00\x00" + syncsafe(len(body)) + body + mpegFrame * frames)
+
+def makeBook(rnd, i, authors):
+    title = " ".join(rnd.sample(words, 3)).title()
+    return {"asin": f"B{i:09d}", "title": title, "author": rnd.choice(authors), "narrator": f"{rnd.choice(firstNames)} {rnd.choice(lastNames)}",
+            "series": f"The {rnd.choice(words).title()} Saga", "part": str(rnd.randint(1, 9)), "minutes": rnd.randint(120, 1500)}
+
+def bookTags(rnd, b):
+    #half the books are fully tagged, some have no ASIN, some have no tags at all
+    kind = rnd.random()
+    if kind < 0.5:
+        return [("TIT2", b["title"]), ("TPE1", b["author"]), ("TCOM", b["narrator"]), ("TALB", b["series"]), ("TXXX", ("AUDIBLE_ASIN", b["asin"]))]
+    elif kind < 0.8:
+        return [("TIT2", b["title"]), ("TPE1", b["author"]), ("TALB", b["title"])]
+    return []
+
+def generateLibrary(source, files, frames, rnd):
+    #single-file, multi-file, multi-CD and collection layouts until there are enough files
+    authorCount = max(10, files // 40)
+    authors = [f"{rnd.choice(firstNames)} {chr(65 + i % 26)}. {rnd.choice(lastNames)} {i}" for i in range(authorCount)]
+    books = []
+    count = 0
+    while count < files:
+        b = makeBook(rnd, len(books), authors)
+        books.append(b)
+        tags = bookTags(rnd, b)
+        folder = f"{b['author']} - {b['title']}"
+        layout = rnd.random()
+        if layout < 0.4:
+            writeStub(os.path.join(source, folder, f"{b['title']}.m4b"), tags, frames)
+            count += 1
+        elif layout < 0.7:
+            for t in range(1, 6):
+                writeStub(os.path.join(source, folder, f"{b['title']} - Track {t:02d}.mp3"), tags, frames)
+            count += 5
+        elif layout < 0.9:
+            for cd in range(1, 3):
+                for t in range(1, 4):
+                    writeStub(os.path.join(source, folder, f"CD {cd}", f"Track {t:02d}.mp3"), tags, frames)
+            count += 6
+        else:
+            collection = f"{b['series']} Collection {len(books)}"
+            for c in range(4):
+                if c:
+                    b = makeBook(rnd, len(books), authors)
+                    books.append(b)
+                writeStub(os.path.join(source, collection, b["title"], f"{b['title']}.mp3"), bookTags(rnd, b), frames)
+            count += 4
+
+    return books
+
+class StandInDriver:
+    #stands in for the Selenium webdriver, the page is fetched without a browser
+    def __init__(self):
+        self.page_source = ""
+        self.timeout = None
+
+    def set_page_load_timeout(self, seconds):
+        self.timeout = seconds
+
+    def get(self, url):
+        self.page_source = httpx.get(url, timeout=self.timeout).text
+
+    def quit(self):
+        pass
+
+def resetState():
+    #module level state from a previous run points at another work folder
+    myx_catalog.connection = None
+    myx_catalog.seen.clear()
+    myx_audible.pendingAsins.clear()
+    myx_audible.resolvedAsins.clear()
+    myx_audible.authorCatalogs.clear()
+    myx_library.libraries.clear()
+    myx_utilities.bookIndex.clear()
+    myx_utilities.bookIndexLoaded = False
+    myx_authors.aliases.clear()
+    myx_authors.configured.clear()
+    myx_authors.aliasesLoaded = False
+    myx_authors.identities.clear()
+
+def makeConfig(work, source, media, logs, standIns):
+    config = {"Config": {
+        "metadata": "mam-audible", "matchrate": 70, "fuzzy_match": "token_sort", "log_path": logs, "session": "bench",
+        "paths": [{"files": ["**/*.m4b", "**/*.mp3"], "source_path": source, "media_path": media}],
+        "flags": {"dry_run": 0, "verbose": 0, "multibook": 0, "ebooks": 0, "no_opf": 0, "no_cache": 0, "fixid3": 0, "add_narrators": 0},
+        "target_path": {"in_series": "{author}/{series}/{series} #{part} - {title}", "no_series": "{author}/{title}", "disc_folder": "{title} {disc}"},
+        "tokens": {"skip_series": 0,
+                   "kw_ignore": [".", ":", "_", "[", "]", "{", "}", ",", ";", "(", ")"],
+                   "kw_ignore_words": ["the", "and", "m4b", "mp3", "series", "audiobook", "audiobooks", "book", "part", "track", "novel", "disc"],
+                   "title_patterns": ["-end", "\\bpart\\b", "\\btrack\\b", "\\bof\\b", "\\bbook\\b", "m4b", "\\(", "\\)", "_", "\\[", "\\]", "\\.", "\\s?-\\s?"]}}}
+    configFile = os.path.join(work, "config.json")
+    with open(configFile, "w") as f:
+        f.write(json.dumps(config))
+
+    argv = sys.argv
+    sys.argv = ["booktree", configFile]
+    try:
+        return myx_args.Config(myx_args.importArgs())
+    finally:
+        sys.argv = argv
+
+def run(files, args, rnd):
+    work = tempfile.mkdtemp(prefix=f"booktree_bench_{files}_", dir=args.work_dir)
+    source = os.path.join(work, "source")
+    media = os.path.join(work, "media")
+    logs = os.path.join(work, "logs")
+    for d in [source, media, logs, os.path.join(work, "__cache__", "book"), os.path.join(work, "__cache__", "mam"), os.path.join(work, "__cache__", "audible"), os.path.join(work, "__cache__", "goodreads")]:
+        os.makedirs(d, exist_ok=True)
+    shutil.copytree(os.path.join(root, "templates"), os.path.join(work, "templates"))
+
+    print(f"Generating {files} files in {source}...")
+    books = generateLibrary(source, files, args.frames, rnd)
+
+    latency = {"audible": args.latency_audible / 1000, "mam": args.latency_mam / 1000,
+               "search": args.latency_search / 1000, "goodreads": args.latency_search / 1000}
+
+    results = []
+    with StandIns(books, latency) as standIns:
+        myx_audible.audible_api = standIns.url
+        myx_mam.mam_url = standIns.url
+        search.search_engines = {"goodreads": standIns.url, "google": standIns.url}
+        goodreads.Goodreads.start_webdriver = lambda self, headless: StandInDriver()
+
+        cwd = os.getcwd()
+        os.chdir(work)
+        try:
+            attempts = ["cold"] + (["warm"] if args.warm else []) + (["offline"] if args.offline else [])
+            for attempt in attempts:
+                resetState()
+                cfg = makeConfig(work, source, media, logs, standIns)
+                if attempt in ["warm", "offline"]:
+                    #reprocess everything, answered from the caches built by the cold run
+                    cfg._data["Config"]["flags"]["no_cache"] = 1
+                if attempt == "offline":
+                    cfg._data["Config"]["flags"]["offline"] = 1
+                logfile = os.path.join(logs, f"booktree_log_{attempt}.csv")
+
+                standIns.counters.clear()
+                myx_perf.reset()
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(sys.stdout if args.show_output else open(os.devnull, "w")):
+                    booktree.buildTreeFromHybridSources(source, media, cfg.get("Config/paths")[0]["files"], logfile, cfg)
+                    myx_utilities.saveBookIndex(cfg)
+                    myx_library.saveLibraries()
+                elapsed = time.perf_counter() - start
+
+                perf = myx_perf.report()
+                results.append({"files": files, "books": len(books), "run": attempt, "seconds": elapsed,
+                                "books_per_second": len(books) / elapsed, "stages": perf["stages"], "counters": perf["counters"],
+                                "requests": dict(standIns.counters)})
+        finally:
+            os.chdir(cwd)
+
+    if not args.keep:
+        shutil.rmtree(work, ignore_errors=True)
+
+    return results
+
+def report(result):
+    print(f"\n{result['files']} files, {result['books']} books ({result['run']}): {result['seconds']:.1f}s, {result['books_per_second']:.1f} books/s")
+    for name, s in sorted(result["stages"].items(), key=lambda s: -s[1]["seconds"]):
+        print(f"\t{name:>18}: {s['seconds']:8.2f}s {100 * s['seconds'] / result['seconds']:5.1f}%  cpu {s['cpu']:8.2f}s  {s['calls']} calls")
+    for name, n in sorted(result["counters"].items()):
+        print(f"\t{name:>18}: {n}")
+    print(f"\t{'requests':>18}: {result['requests']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="End to end booktree benchmark on a synthetic library with local service stand-ins")
+    parser.add_argument("--files", type=int, nargs="+", default=[1000, 10000, 100000], help="Library sizes, in files")
+    parser.add_argument("--frames", type=int, default=4, help="MPEG frames per stub file")
+    parser.add_argument("--latency-audible", type=float, default=50, help="Audible stand-in latency in ms")
+    parser.add_argument("--latency-mam", type=float, default=50, help="MAM stand-in latency in ms")
+    parser.add_argument("--latency-search", type=float, default=100, help="Goodreads/Google stand-in latency in ms")
+    parser.add_argument("--warm", action="store_true", help="Also run a second pass answered from the caches")
+    parser.add_argument("--offline", action="store_true", help="Also run an offline pass, cache misses are not looked up")
+    parser.add_argument("--work-dir", default=None, help="Where to generate the libraries, defaults to the temp folder")
+    parser.add_argument("--keep", action="store_true", help="Keep the generated libraries")
+    parser.add_argument("--show-output", action="store_true", help="Show booktree's own output")
+    parser.add_argument("--json", default=None, help="Also write the results to this file")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    if shutil.which("ffprobe") is None:
+        print("ffprobe was not found, files will be processed without id3 tags")
+
+    rnd = random.Random(args.seed)
+    results = []
+    for files in args.files:
+        for result in run(files, args, rnd):
+            report(result)
+            results.append(result)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            f.write(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
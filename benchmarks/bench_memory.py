@@ -0,0 +1,67 @@
+import os, sys
+import argparse
+import random
+import time
+import tracemalloc
+
+#run from anywhere, booktree modules live one folder up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import myx_classes
+
+#Peak memory of the book model: books with their files, id3 metadata and match candidates
+authors = [f"Author {i} Lastname" for i in range(300)]
+narrators = [f"Narrator {i} Lastname" for i in range(200)]
+series = [f"Series {i}" for i in range(1000)]
+
+def makeBook(rnd, i):
+    #build names the way the parsers do, so equal names are different str objects until interned
+    book = myx_classes.Book(asin=f"B{i:09d}", title=f"Title {i}", length=rnd.randint(60, 1800))
+    book.authors.append(myx_classes.Contributor("".join(rnd.choice(authors))))
+    book.narrators.append(myx_classes.Contributor("".join(rnd.choice(narrators))))
+    book.series.append(myx_classes.Series("".join(rnd.choice(series)), str(rnd.randint(1, 12))))
+    return book
+
+def run(books, files, candidates, keep):
+    rnd = random.Random(42)
+    library = []
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    for i in range(books):
+        mb = myx_classes.MAMBook(f"Book Folder {i}")
+        for j in range(files):
+            bf = myx_classes.BookFile(f"Book Folder {i}/Track {j:02d}.mp3", f"/data/downloads/Book Folder {i}/Track {j:02d}.mp3", "/data/downloads", "/data/media")
+            bf.ffprobeBook = makeBook(rnd, i)
+            mb.files.append(bf)
+        mb.ffprobeBook = mb.files[0].ffprobeBook
+
+        #MAM and Audible candidates, as the searches return them
+        mb.mamMatches = [makeBook(rnd, i * candidates + c) for c in range(candidates)]
+        mb.audibleMatches = [makeBook(rnd, i * candidates + c) for c in range(candidates)]
+        mb.bestMAMMatch = mb.mamMatches[0]
+        mb.bestAudibleMatch = mb.audibleMatches[0]
+        if not keep:
+            mb.dropCandidates()
+
+        library.append(mb)
+
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return peak, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description="Peak memory of the booktree data model per 10k books")
+    parser.add_argument("--books", type=int, default=10000, help="Number of books to build")
+    parser.add_argument("--files", type=int, default=3, help="Files per book")
+    parser.add_argument("--candidates", type=int, default=20, help="MAM and Audible candidates per book")
+    args = parser.parse_args()
+
+    for keep in [True, False]:
+        peak, elapsed = run(args.books, args.files, args.candidates, keep)
+        label = "keeping candidates" if keep else "dropping candidates"
+        print(f"{label:>20}: peak {peak / 1024 / 1024:8.1f} MiB, {peak / 1024 / 1024 * 10000 / args.books:8.1f} MiB per 10k books, {elapsed:.2f}s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+#Local stand-ins for Audible, MAM and the Goodreads/Google search, serving a synthetic catalog
+def tokens(text):
+    return set(re.findall(r"[a-z0-9]{2,}", str(text).lower()))
+
+class Catalog:
+    def __init__(self, books):
+        #books are dicts: asin, title, author, narrator, series, part, minutes
+        self.books = books
+        self.byAsin = {b["asin"]: b for b in books}
+        self.byToken = {}
+        for b in books:
+            for t in tokens(" ".join([b["title"], b["author"], b["series"]])):
+                self.byToken.setdefault(t, []).append(b)
+
+    def search(self, text, limit=10):
+        #rank books by how many of the query tokens they share
+        scores = {}
+        for t in tokens(text):
+            for b in self.byToken.get(t, []):
+                scores[b["asin"]] = scores.get(b["asin"], 0) + 1
+        ranked = sorted(scores.items(), key=lambda s: -s[1])[:limit]
+        return [self.byAsin[asin] for asin, score in ranked]
+
+    def byAuthor(self, author):
+        wanted = tokens(author)
+        return [b for b in self.books if tokens(b["author"]) == wanted]
+
+def audibleProduct(b):
+    return {"asin": b["asin"], "title": b["title"], "subtitle": "", "publisher_summary": f"A synthetic book by {b['author']}.",
+            "runtime_length_min": b["minutes"], "authors": [{"asin": "A0", "name": b["author"]}], "narrators": [{"name": b["narrator"]}],
+            "publication_name": b["series"], "series": [{"asin": "S0", "title": b["series"], "sequence": b["part"]}],
+            "language": "english", "relationships": [], "product_images": {}}
+
+def mamTorrent(b, i):
+    return {"id": i, "asin": b["asin"], "title": b["title"], "author_info": json.dumps({"1": b["author"]}),
+            "series_info": json.dumps({"1": [b["series"], b["part"]]}), "lang_code": "ENG", "my_snatched": 1}
+
+def makeHandler(catalog, latency, counters, lock):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def reply(self, status, body, contentType="application/json"):
+            data = body.encode("utf-8") if isinstance(body, str) else body
+            self.send_response(status)
+            self.send_header("Content-Type", contentType)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def count(self, service):
+            with lock:
+                counters[service] = counters.get(service, 0) + 1
+            time.sleep(latency.get(service, 0))
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = {k: v[0] for k, v in parse_qs(url.query).items()}
+
+            if url.path.startswith("/1.0/catalog/products/"):
+                self.count("audible")
+                b = catalog.byAsin.get(url.path.split("/")[-1])
+                if b is None:
+                    return self.reply(404, json.dumps({"message": "Product not found"}))
+                return self.reply(200, json.dumps({"product": audibleProduct(b)}))
+
+            if url.path == "/1.0/catalog/products":
+                self.count("audible")
+                if "asins" in query:
+                    found = [catalog.byAsin[a] for a in query["asins"].split(",") if a in catalog.byAsin]
+                    return self.reply(200, json.dumps({"products": [audibleProduct(b) for b in found]}))
+                if ("page" in query) and ("author" in query):
+                    size = int(query.get("num_results", 50))
+                    page = int(query["page"])
+                    found = catalog.byAuthor(query["author"])[(page - 1) * size:page * size]
+                    return self.reply(200, json.dumps({"products": [audibleProduct(b) for b in found]}))
+                text = " ".join([query.get(k, "") for k in ["title", "author", "narrator", "keywords"]])
+                return self.reply(200, json.dumps({"products": [audibleProduct(b) for b in catalog.search(text)]}))
+
+            if url.path == "/jsonLoad.php":
+                self.count("mam")
+                return self.reply(200, "{}")
+
+            if url.path == "/search":
+                self.count("search")
+                found = catalog.search(query.get("q", ""), limit=3)
+                host = f"http://{self.headers['Host']}"
+                #google style links first, goodreads result links are found by their class
+                links = "".join([f'<a href="/url?sa=t&url={host}/book/show/{b["asin"]}&ved=0">{b["title"]}</a>'
+                                 f'<a class="bookTitle" href="/book/show/{b["asin"]}?from_search=true">{b["title"]}</a>' for b in found])
+                return self.reply(200, f"<html><body>{links}</body></html>", "text/html")
+
+            if url.path.startswith("/book/show/"):
+                self.count("goodreads")
+                b = catalog.byAsin.get(url.path.split("/")[-1])
+                if b is None:
+                    return self.reply(404, "<html></html>", "text/html")
+                page = (f'<html><body><div data-testid="description"><span class="Formatted">A synthetic book by {b["author"]}.</span></div>'
+                        f'<div data-testid="genresList"><span class="Button__labelItem">Fantasy</span><span class="Button__labelItem">Fiction</span></div>'
+                        f'<div class="BookDetails"><p data-testid="publicationInfo">First published January 1, 2001</p>'
+                        f'<div class="DescListItem"><dt>Series</dt><dd><a href="/series/1">{b["series"]}</a> (#{b["part"]})</dd></div>'
+                        f'<div class="DescListItem"><dt>Published</dt><dd><div data-testid="contentContainer">January 1, 2001 by Synthetic Press</div></dd></div>'
+                        f'</div></body></html>')
+                return self.reply(200, page, "text/html")
+
+            self.reply(404, "{}")
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+
+            if url.path == "/tor/js/loadSearchJSONbasic.php":
+                self.count("mam")
+                text = re.sub(r"@dummy mamDummy|\b(m4b|mp3|m4a)\b", " ", body["tor"]["text"])
+                found = catalog.search(text, limit=5)
+                if len(found) == 0:
+                    return self.reply(200, '{"error":"Nothing returned, out of 0"}')
+                return self.reply(200, json.dumps({"data": [mamTorrent(b, i) for i, b in enumerate(found)]}))
+
+            self.reply(404, "{}")
+
+    return Handler
+
+class StandIns:
+    #one local server for all the services, on a random port
+    def __init__(self, books, latency=None):
+        self.catalog = Catalog(books)
+        self.latency = latency or {}
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), makeHandler(self.catalog, self.latency, self.counters, self.lock))
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
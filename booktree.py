@@ -2,18 +2,24 @@ from pathlib import Path
 from pprint import pprint
 from datetime import datetime
 from glob import iglob, glob
-import os, sys, subprocess, shlex, re
+import os, sys, subprocess, shlex, re, time
 import myx_classes
 import myx_audible
 import myx_utilities
 import myx_mam
 import myx_args
+import myx_library
+import myx_perf
+import myx_queue
+import myx_authors
+import myx_cache
 import csv
 import httpx
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import goodreads
 
 #Main Functions
-def buildTreeFromLog(files, logfile, cfg):
+def buildTreeFromLog(files, logfile, cfg, client=httpx):
     #Variables
     allFiles=[]
     matchedFiles=[]
@@ -91,12 +97,13 @@ def buildTreeFromLog(files, logfile, cfg):
                     
                     #Search Audible using the provided id3 metadata in the input file
                     if (not ebooks):
-                        book[b].getAudibleBooks(httpx, book[b].ffprobeBook, cfg)
+                        book[b].getAudibleBooks(client, book[b].ffprobeBook, cfg)
                         if (book[b].bestAudibleMatch is not None):
                             book[b].metadata = "audible"                    
 
-                    print (f"Found {len(book[b].mamMatches)} MAM matches, {len(book[b].audibleMatches)} Audible Matches")
+                    print (f"Found {book[b].getMAMCount()} MAM matches, {book[b].getAudibleMatchCount()} Audible Matches")
                     myx_utilities.printDivider()
+                    book[b].dropCandidates()
 
                     #if matched, add to matchedFiles
                     if book[b].matchFound():
@@ -130,24 +137,193 @@ def buildTreeFromLog(files, logfile, cfg):
 
     return    
 
-def buildTreeFromHybridSources(path, mediaPath, files, logfile, cfg):
+def matchBook(mb, cfg, goodreads_book, client=httpx):
+    #Config variables
+    metadata = cfg.get("Config/metadata")
+    ebooks = bool(cfg.get("Config/flags/ebooks"))
+    multibook = bool(cfg.get("Config/flags/multibook"))
+    useAsin = bool(cfg.get("Config/confidence/asin", 1))
+    highMatchRate = int(cfg.get("Config/confidence/high_matchrate", 100))
+    skipGoodreads = bool(cfg.get("Config/confidence/skip_goodreads", 1))
+
+    #MAM search has already been done, check if it's a foreign book
+    isForeignBook = False
+    if (mb.bestMAMMatch is not None):
+        isForeignBook = (mb.bestMAMMatch.language.lower() !=  "english")
+    
+    #Audible search only if this is not ebooks/multibook and metadatasource includes audible, otherwise MAM search is enough
+    tier = "low"
+    if (not ebooks) and ((metadata == "audible") or (metadata == "mam-audible")):
+        asinTier = mb.matchAsin(client, cfg) if useAsin else None
+        if asinTier is not None:
+            #the ASIN settles it, no searches needed
+            tier = asinTier
+            mb.metadata = "audible"
+            myx_perf.count("saved audible searches", 1 if (isForeignBook or multibook or myx_utilities.isMultiBookCollection(mb.files[0].file)) else 2)
+        elif isForeignBook:
+            #if bestMAMMatch is a foreign book, getAudible using MAM Metadata
+            mb.getAudibleBooks(client, mb.bestMAMMatch, cfg)
+            if (mb.bestAudibleMatch is not None):
+                mb.metadata = "audible"
+        else:
+            #This is not a foreign book, do an Audible Search using id3 values first   
+            id3BestMatch = mb.getAudibleBooks(client, mb.ffprobeBook, cfg)
+
+            #if this book is NOT a multibook, try MAM metadata search, if this is a collection, ignore MAM
+            if (not multibook) and (not myx_utilities.isMultiBookCollection(mb.files[0].file)):
+                #a high confidence id3 match doesn't need a second search with the MAM metadata
+                if (id3BestMatch is not None) and (id3BestMatch.matchRate >= highMatchRate):
+                    tier = "high"
+                    mb.metadata = "audible"
+                    myx_perf.count("saved audible searches")
+                else:
+                    mamBestMatch = mb.getAudibleBooks(client, mb.bestMAMMatch, cfg)
+
+                    if (id3BestMatch is not None) or (mamBestMatch is not None):
+                        mb.metadata = "audible" 
+                        #Override mamBest match if id3 has higher match rate, or if MAM didn't match
+                        if (id3BestMatch is not None) and (mamBestMatch is not None):
+                            #A match was found using either metadata
+                            if id3BestMatch.matchRate > mamBestMatch.matchRate:
+                                #Replace bestAudibleMatch with the better matchrate
+                                mb.bestAudibleMatch = id3BestMatch
+                            else:
+                                mb.bestAudibleMatch = mamBestMatch
+                        elif (id3BestMatch is not None) and (mamBestMatch is None):
+                            #Replace bestAudibleMatch with the better matchrate
+                            mb.bestAudibleMatch = id3BestMatch
+            else:
+                #this is multibook so audible only
+                if id3BestMatch is not None:
+                    mb.metadata = "audible" 
+
+        #only books that went through the Audible stage have a confidence tier
+        myx_perf.count(f"confidence {tier}")
+
+    # Scrape available metadata from Goodreads, unless the Audible match is certain and will be used anyway
+    if skipGoodreads and (tier != "low") and (mb.metadata == "audible"):
+        myx_perf.count("saved goodreads lookups")
+    else:
+        try:
+            bk = mb.bestMAMMatch
+            mb.bestMAMMatch = goodreads_book.fetch_all(bk,title=bk.title,author=bk.getAuthors())
+        except Exception as e:
+            print("Couldn't get Goodreads data")
+            mb.bestMAMMatch = bk
+
+    print (f"Found {mb.getMAMCount()} MAM matches, {mb.getAudibleMatchCount()} Audible Matches")
+    myx_utilities.printDivider()
+        
+    mb.isMatched = mb.matchFound()
+    mb.dropCandidates()
+    return mb.isMatched
+
+def matchBooks(normalBooks, cfg, goodreads_book, client=httpx, onBook=None):
+    #onBook is called as each book starts a stage, a worker uses it to keep its leases
+    #config variables
+    metadata = cfg.get("Config/metadata")
+    ebooks = bool(cfg.get("Config/flags/ebooks"))
+
+    #Find Book Matches from MAM first, check if it's a foreign book
+    book_count = len(normalBooks)
+    if ((metadata == "mam") or (metadata == "mam-audible")):
+        for index, mb in enumerate(normalBooks, start=1):
+            print(f"Searching MAM for book {index}/{book_count}: {mb.name}...")
+            if onBook is not None:
+                onBook(mb)
+            #Process these books the same way, essentially based on the first book in the file list
+            with myx_utilities.bookBudget(cfg, mb):
+                mb.getMAMBooks(cfg, mb.files[0])
+            if (mb.bestMAMMatch is not None):
+                mb.metadata = "mam"
+
+    #Resolve all known ASINs (id3 and MAM) in batches, before searching Audible book by book
+    if (not ebooks) and ((metadata == "audible") or (metadata == "mam-audible")):
+        for mb in normalBooks:
+            myx_audible.queueAsin(mb.ffprobeBook.asin)
+            if (mb.bestMAMMatch is not None):
+                myx_audible.queueAsin(mb.bestMAMMatch.asin)
+        myx_audible.resolveAsins(client, cfg)
+
+        #Fetch the catalog of prolific authors once, instead of searching Audible book by book
+        myx_audible.prefetchAuthors(client, cfg, [mb.bestMAMMatch if mb.bestMAMMatch is not None else mb.ffprobeBook for mb in normalBooks])
+
+    #Find Book Matches from Audible and Goodreads
+    for index, mb in enumerate(normalBooks, start=1):
+        #process the book
+        print(f"Processing book {index}/{book_count}: {mb.name}...")
+        if onBook is not None:
+            onBook(mb)
+        with myx_utilities.bookBudget(cfg, mb, last=True):
+            matchBook(mb, cfg, goodreads_book, client)
+
+def runWorker(cfg, client=httpx):
+    #match books from the coordinator's queue until it stays empty, hardlinks are left to the coordinator
+    batch = int(cfg.get("Config/queue/batch", 10))
+    leaseSeconds = float(cfg.get("Config/queue/lease_seconds", 600))
+    maxAttempts = int(cfg.get("Config/queue/max_attempts", 3))
+    pollSeconds = float(cfg.get("Config/queue/poll_seconds", 5))
+    idleExitSeconds = float(cfg.get("Config/queue/idle_exit_seconds", 60))
+
+    worker = myx_queue.getWorkerId()
+    goodreads_book = goodreads.Goodreads(cfg)
+    matched = 0
+    processed = 0
+    idleSince = time.monotonic()
+
+    print(f"Worker {worker} is waiting for books...")
+    try:
+        while True:
+            jobs = myx_queue.claim(worker, batch, leaseSeconds, maxAttempts)
+            if len(jobs) == 0:
+                #books leased by another worker come back to the queue if that worker dies
+                status = myx_queue.getStatus()
+                if ((time.monotonic() - idleSince) > idleExitSeconds) and (status.get("leased", 0) == 0):
+                    break
+                time.sleep(pollSeconds)
+                continue
+
+            #the whole batch is leased together, its leases are extended as each book starts, so a slow batch isn't handed to another worker
+            keys = [key for key, mb in jobs]
+            try:
+                matchBooks([mb for key, mb in jobs], cfg, goodreads_book, client, lambda mb: myx_queue.renew(keys, worker, leaseSeconds))
+            except Exception as e:
+                print(f"Error matching {len(jobs)} books, returning them to the queue: {e}")
+                for key, mb in jobs:
+                    myx_queue.release(key, worker, e, maxAttempts)
+                continue
+
+            for key, mb in jobs:
+                if myx_queue.complete(key, worker, mb):
+                    processed += 1
+                    matched += int(mb.isMatched)
+                else:
+                    print(f"The lease on {mb.name} expired, another worker is processing it")
+            idleSince = time.monotonic()
+    finally:
+        goodreads_book.stop_webdriver(goodreads_book.driver)
+
+    print(f"Worker {worker} finished {processed} books, {matched} matched")
+
+def buildTreeFromHybridSources(path, mediaPath, files, logfile, cfg, client=httpx):
     #Variables
     allFiles=[]
     multiBookCollections=[]
     normalBooks=[]
     matchedFiles=[]
     unmatchedFiles=[]
-    goodreads_book = goodreads.Goodreads()
+    goodreads_book = goodreads.Goodreads(cfg)
 
     #config variables
     format = files
-    metadata = cfg.get("Config/metadata")
     dryRun = bool(cfg.get("Config/flags/dry_run"))
-    ebooks = bool(cfg.get("Config/flags/ebooks"))
     multibook = bool(cfg.get("Config/flags/multibook"))
     verbose = bool(cfg.get("Config/flags/verbose"))
     no_cache = bool(cfg.get("Config/flags/no_cache"))
 
+    #discovery covers the glob and the categorization (probing) of every file
+    discovery = myx_perf.startStage("discovery")
+
     #grab all files and put it in allFiles
     #if there were no patters provided, grab ALL known audiobooks, currently these are M4B and MP3 files
     #find all files that fit the pattern
@@ -160,7 +336,13 @@ def buildTreeFromHybridSources(path, mediaPath, files, logfile, cfg):
     print (f"Found {len(allFiles)} files to process...\n\n")
 
     print (f"Building tree from Hybrid Sources:\nSource:{path}\nMedia:{mediaPath}\nLog:{logfile}\n")
+
+    #load what already exists in the media library
+    library = myx_library.getLibrary(mediaPath, cfg)
+
     book={}
+    linkedFiles=0
+    otherShards=0
 
     #Let's assume that all books are folders, so a file has a parent folder
     print(f"\nCategorizing books from {len(allFiles)} files, please wait...\n")
@@ -169,8 +351,7 @@ def buildTreeFromHybridSources(path, mediaPath, files, logfile, cfg):
         print(f"Categorizing: {f}\r", end="\r")
 
         #create a bookFile
-        fullpath=os.path.join(path, f)
-        bf=myx_classes.BookFile(f, fullpath, path, mediaPath)
+        bf=myx_classes.BookFile(f, os.path.join(path, f), path, mediaPath)
 
         #create dictionary using book (assumed to be the the parent Folder) as the key
         #if there's no parent folder or if multibook is on, then the filename is the key
@@ -179,8 +360,10 @@ def buildTreeFromHybridSources(path, mediaPath, files, logfile, cfg):
         else:
             key=bf.getParentFolder()
 
-        #read metadata
-        bf.ffprobe(key)
+        #books that belong to another shard are left to that process
+        if not myx_utilities.inShard(key, cfg):
+            otherShards += 1
+            continue
 
         #at this point, the books is either at the root, or under a book folder
         #print (f"Adding {bf.fullPath}\nParent:{bf.getParentFolder()}", end="\r")
@@ -191,9 +374,8 @@ def buildTreeFromHybridSources(path, mediaPath, files, logfile, cfg):
         if hashKey in book:
             book[hashKey].files.append(bf)
         else:
-            #New MAMBook file has a name, a file and a ffprobeBook
+            #New MAMBook file has a name and a file, its ffprobeBook comes from probing its files below
             book[hashKey]=myx_classes.MAMBook(key)
-            book[hashKey].ffprobeBook=bf.ffprobeBook
             book[hashKey].isSingleFile=(multibook) or (bf.hasNoParentFolder())
             book[hashKey].files.append(bf)
             book[hashKey].metadata = "id3"
@@ -213,6 +395,25 @@ def buildTreeFromHybridSources(path, mediaPath, files, logfile, cfg):
                 book[hashKey].isSingleFile=True
                 book[hashKey].files.append(f)
 
+    #books whose files are all hardlinked into the library are dropped before they're probed
+    #a partly linked book (an interrupted run, a chapter added later) keeps all its files, hardlinkFile skips the existing links
+    if not no_cache:
+        for hashKey in [k for k, b in book.items() if all(library.isLinked(bf.fullPath) for bf in b.files)]:
+            linkedFiles += len(book[hashKey].files)
+            del book[hashKey]
+
+    #read metadata, the tags of one representative file per book and the duration of the others
+    for b in book.values():
+        b.probeFiles(cfg)
+
+    myx_perf.endStage(discovery)
+
+    if linkedFiles:
+        print(f"\nSkipped {linkedFiles} files that are already hardlinked in {mediaPath}")
+
+    if otherShards:
+        print(f"\nSkipped {otherShards} files that belong to other shards")
+
     #for multi-file folders/book - check if there are any multi-book collections
     if multibook:
         print(f"\nCategorized {len(allFiles)} files into books - multibook is on")
@@ -224,7 +425,7 @@ def buildTreeFromHybridSources(path, mediaPath, files, logfile, cfg):
     #OK, now that you have categorized the files, we can start processing them
     #At this point all Book files should have already been probed
 
-    #Find Book Matches from MAM and Audible
+    #Find the books that still need processing
     index = 0
     book_count = len(book)
     print(f"\nPreparing to process {book_count} books...\n")
@@ -233,74 +434,37 @@ def buildTreeFromHybridSources(path, mediaPath, files, logfile, cfg):
         #if this book has not been processed before AND it is not a multibook collection
         #print (f"Book: {b} isCached: {book[b].isCached('book')}")
         if ((no_cache) or (not book[b].isCached("book", cfg))):
-            #process the book
-            print(f"Processing book {index}/{book_count}: {book[b].name}...")
-            normalBooks.append(book[b])            
-            #Process these books the same way, essentially based on the first book in the file list
-            bf = book[b].files[0]
-
-            #get MAM first, check if it's a foreign book
-            isForeignBook = False
-            if ((metadata == "mam") or (metadata == "mam-audible")):
-                book[b].getMAMBooks(cfg, bf)
-                if (book[b].bestMAMMatch is not None):
-                    book[b].metadata = "mam"
-                    isForeignBook = (book[b].bestMAMMatch.language.lower() !=  "english")
-            
-            #Audible search only if this is not ebooks/multibook and metadatasource includes audible, otherwise MAM search is enough
-            if (not ebooks) and ((metadata == "audible") or (metadata == "mam-audible")):
-                if isForeignBook:
-                    #if bestMAMMatch is a foreign book, getAudible using MAM Metadata
-                    book[b].getAudibleBooks(httpx, book[b].bestMAMMatch, cfg)
-                    if (book[b].bestAudibleMatch is not None):
-                        book[b].metadata = "audible"
-                else:
-                    #This is not a foreign book, do an Audible Search using id3 values first   
-                    id3BestMatch = book[b].getAudibleBooks(httpx, book[b].ffprobeBook, cfg)
-
-                    #if this book is NOT a multibook, try MAM metadata search, if this is a collection, ignore MAM
-                    if (not multibook) and (not myx_utilities.isMultiBookCollection(book[b].files[0].file)):
-                        mamBestMatch = book[b].getAudibleBooks(httpx, book[b].bestMAMMatch, cfg)
-
-                        if (id3BestMatch is not None) or (mamBestMatch is not None):
-                            book[b].metadata = "audible" 
-                            #Override mamBest match if id3 has higher match rate, or if MAM didn't match
-                            if (id3BestMatch is not None) and (mamBestMatch is not None):
-                                #A match was found using either metadata
-                                if id3BestMatch.matchRate > mamBestMatch.matchRate:
-                                    #Replace bestAudibleMatch with the better matchrate
-                                    book[b].bestAudibleMatch = id3BestMatch
-                                else:
-                                    book[b].bestAudibleMatch = mamBestMatch
-                            elif (id3BestMatch is not None) and (mamBestMatch is None):
-                                #Replace bestAudibleMatch with the better matchrate
-                                book[b].bestAudibleMatch = id3BestMatch
-                    else:
-                        #this is multibook so audible only
-                        if id3BestMatch is not None:
-                            book[b].metadata = "audible" 
-
-            # Scrape available metadata from Goodreads
-            try:
-                bk = book[b].bestMAMMatch
-                book[b].bestMAMMatch = goodreads_book.fetch_all(bk,title=bk.title,author=bk.getAuthors())
-            except Exception as e:
-                print("Couldn't get Goodreads data")
-                book[b].bestMAMMatch = bk
-
-            print (f"Found {len(book[b].mamMatches)} MAM matches, {len(book[b].audibleMatches)} Audible Matches")
-            myx_utilities.printDivider()
-                
-            #if matched, add to matchedFiles
-            if book[b].matchFound():
-                book[b].isMatched=True
-                matchedFiles.append(book[b])
-            else:
-                unmatchedFiles.append(book[b])
+            #is this book already in the library? check before doing any network lookups
+            inLibrary = library.findAsin(book[b].ffprobeBook.asin)
+            if (not no_cache) and (inLibrary is not None):
+                print(f"Skipping: {book[b].name}, already in the library at {inLibrary}...")
+                continue
 
+            normalBooks.append(book[b])            
         else:
             print(f"Skipping: {book[b].name}...")
 
+    #Find Book Matches from MAM, Audible and Goodreads, here or on the queue workers
+    queueRole = cfg.get("Config/queue/role", "")
+    if queueRole == "coordinator":
+        jobs = myx_queue.coordinate(normalBooks, path, cfg)
+        normalBooks = [mb for key, mb in jobs]
+    else:
+        matchBooks(normalBooks, cfg, goodreads_book, client)
+
+    #warming the caches stops here, nothing is linked or logged
+    if bool(cfg.get("Config/warm/enabled")):
+        goodreads_book.stop_webdriver(goodreads_book.driver)
+        print(f"\nWarmed the caches for {len(normalBooks)} books from {path}")
+        return
+
+    for mb in normalBooks:
+        #if matched, add to matchedFiles
+        if mb.isMatched:
+            matchedFiles.append(mb)
+        else:
+            unmatchedFiles.append(mb)
+
     # goodreads scraping is finished, kill the webdriver    
     goodreads_book.stop_webdriver(goodreads_book.driver)
     
@@ -318,6 +482,10 @@ def buildTreeFromHybridSources(path, mediaPath, files, logfile, cfg):
     print (f"\nLogging {len(normalBooks)} processed books")
     myx_utilities.logBooks(logfile, normalBooks, cfg)  
 
+    #the queued books are finished once they're linked and logged
+    if queueRole == "coordinator":
+        myx_queue.markLinked([key for key, mb in jobs])
+
     print(f"Completed processing {len(normalBooks)} books. {len(matchedFiles)}/{len(normalBooks) - len(matchedFiles)} match/unmatch ratio.")
     myx_utilities.printDivider()
 
@@ -325,7 +493,70 @@ def buildTreeFromHybridSources(path, mediaPath, files, logfile, cfg):
     return
 
 
+def buildPath(index, count, paths, logfile, cfg, client=httpx):
+    #validate that source_path and media_path exists
+    files=paths["files"]
+    path=paths["source_path"]
+    mediaPath=paths["media_path"]
+
+    if isinstance(sys.stdout, myx_utilities.PrefixedOutput):
+        sys.stdout.setLabel(f"{index}/{count} {os.path.basename(os.path.normpath(path))}")
+
+    start = time.perf_counter()
+    try:
+        if (os.path.exists(path) and os.path.exists(mediaPath)):
+            #build tree from identified sources
+            if (cfg.get("Config/metadata") == "log"):
+                buildTreeFromLog(files, logfile, cfg, client)
+            else:
+                buildTreeFromHybridSources(path, mediaPath, files, logfile, cfg, client)            
+        else:
+            print(f"Your source and media paths are invalid. Please check and try again!\nSource:{path}\nMedia:{mediaPath}")
+            return
+
+        print(f"Finished path {index}/{count} {path} in {time.perf_counter() - start:.1f}s")
+    finally:
+        sys.stdout.flush()
+
+def warmCaches(logfile, cfg, client=httpx):
+    #fill the caches ahead of a big import, at the configured rate limits
+    maxPages = int(cfg.get("Config/prefetch/max_pages", 10))
+    asins = cfg.get("Config/warm/asins", [])
+    authors = cfg.get("Config/warm/authors", [])
+    sources = cfg.get("Config/warm/sources", [])
+
+    #ASINs are resolved in batches into the local Audible catalog
+    if len(asins):
+        print(f"Warming {len(asins)} ASINs")
+        for asin in asins:
+            myx_audible.queueAsin(asin)
+        myx_audible.resolveAsins(client, cfg)
+
+    #the whole catalog of each author, the same pages the prefetch of a real run asks for
+    if len(authors) and bool(cfg.get("Config/flags/no_catalog")):
+        print(f"Skipping {len(authors)} authors, their catalogs aren't used with --no-catalog")
+    for index, author in enumerate(authors if not bool(cfg.get("Config/flags/no_catalog")) else [], start=1):
+        print(f"Warming the Audible catalog of author {index}/{len(authors)}: {author}")
+        myx_audible.getAuthorCatalog(client, cfg, myx_utilities.cleanseAuthor(author), maxPages=maxPages)
+
+    #source paths go through the same MAM, Audible and Goodreads lookups as a real run
+    allPaths = cfg.get("Config/paths")
+    if len(sources):
+        allPaths = [dict(allPaths[0], source_path=source) for source in sources]
+    elif len(asins) or len(authors):
+        allPaths = []
+
+    if len(allPaths) and (cfg.get("Config/metadata") == "log"):
+        print("There are no lookups to warm when the metadata comes from a log")
+        return
+
+    for i, paths in enumerate(allPaths, 1):
+        buildPath(i, len(allPaths), paths, logfile, cfg, client)
+
 def main(cfg):
+    start = time.perf_counter()
+    perfReport = bool(cfg.get("Config/flags/perf_report"))
+
     #make sure log_path exists
     log_path=cfg.get("Config/log_path")
     if (len(log_path)==0):
@@ -334,23 +565,110 @@ def main(cfg):
     if not os.path.exists(os.path.abspath(log_path)):
         os.makedirs(os.path.abspath(log_path), exist_ok=True)
 
-    #create the logfile
-    logfile=os.path.join(os.path.abspath(log_path),f"booktree_log_{datetime.now().strftime('%Y%m%d%H%M%S')}.csv")
-
-    for paths in cfg.get("Config/paths"):
-        #validate that source_path and media_path exists
-        files=paths["files"]
-        path=paths["source_path"]
-        mediaPath=paths["media_path"]
-
-        if (os.path.exists(path) and os.path.exists(mediaPath)):
-            #build tree from identified sources
-            if (cfg.get("Config/metadata") == "log"):
-                buildTreeFromLog(files, logfile, cfg)
-            else:
-                buildTreeFromHybridSources(path, mediaPath, files, logfile, cfg)            
-        else:
-            print(f"Your source and media paths are invalid. Please check and try again!\nSource:{path}\nMedia:{mediaPath}")
+    #the cache backend, files or sqlite
+    myx_cache.setBackend(cfg)
+
+    #cache maintenance doesn't process anything
+    if cfg.get("Config/cache_maintenance/action") is not None:
+        myx_cache.runMaintenance(cfg, {"audible": myx_audible.compactResponse, "mam": myx_mam.compactResults})
+        return
+
+    #learned and configured author aliases
+    myx_authors.loadAliases(cfg)
+
+    #consolidating author folders doesn't process anything
+    if bool(cfg.get("Config/consolidate_authors")):
+        for paths in cfg.get("Config/paths"):
+            if os.path.exists(paths["media_path"]):
+                myx_library.getLibrary(paths["media_path"], cfg).consolidateAuthors(bool(cfg.get("Config/flags/dry_run")))
+        myx_library.saveLibraries()
+        return
+
+    #merging the logs of a sharded run doesn't process anything
+    mergeLogs = cfg.get("Config/merge_logs", [])
+    if len(mergeLogs):
+        merged=os.path.join(os.path.abspath(log_path),f"booktree_log_{datetime.now().strftime('%Y%m%d%H%M%S')}_merged.csv")
+        myx_utilities.mergeLogs(mergeLogs, merged)
+        return
+
+    #create the logfile, every shard writes its own
+    shardCount = int(cfg.get("Config/shard/count", 1))
+    shard = f"_shard{cfg.get('Config/shard/index', 1)}of{shardCount}" if shardCount > 1 else ""
+    logfile=os.path.join(os.path.abspath(log_path),f"booktree_log_{datetime.now().strftime('%Y%m%d%H%M%S')}{shard}.csv")
+    if len(shard):
+        print(f"Processing shard {cfg.get('Config/shard/index', 1)} of {shardCount}")
+
+    #paths can be processed concurrently, sharing one HTTP client, the caches and the rate limiters
+    allPaths = cfg.get("Config/paths")
+    workers = max(1, int(cfg.get("Config/concurrency/paths", 1)))
+    concurrent = (workers > 1) and (len(allPaths) > 1)
+
+    #profile the whole run, or just the stages asked for
+    #cProfile only sees the thread that started it, concurrent paths need the sampling profiler
+    profileMode = cfg.get("Config/profile/mode", "")
+    if len(profileMode) and (profileMode != "sample") and concurrent:
+        print(f"cProfile can't see the threads of --path-workers {workers}, using the sampling profiler instead")
+        profileMode = "sample"
+    if len(profileMode):
+        myx_perf.startProfile(profileMode, cfg.get("Config/profile/stages", []), cfg.get("Config/profile/interval_ms", 5) / 1000)
+
+    #an interrupted or failed run still saves its profile
+    try:
+        #load the processed-book index once, instead of checking the book cache per book
+        myx_utilities.loadBookIndex(cfg)
+        myx_utilities.setRateLimits(cfg)
+
+        #every line printed by a path is prefixed with its label, so their progress can be told apart
+        stdout = sys.stdout
+        if concurrent:
+            sys.stdout = myx_utilities.PrefixedOutput(stdout)
+            print(f"Processing {len(allPaths)} paths, {min(workers, len(allPaths))} at a time")
+
+        try:
+            connect, read = myx_utilities.getTimeout(cfg)
+            with httpx.Client(limits=httpx.Limits(max_connections=max(10, 4 * workers)), timeout=httpx.Timeout(read, connect=connect)) as client:
+                if cfg.get("Config/queue/role", "") == "worker":
+                    runWorker(cfg, client)
+                elif bool(cfg.get("Config/warm/enabled")):
+                    warmCaches(logfile, cfg, client)
+                elif concurrent:
+                    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="booktree-path") as executor:
+                        futures = {executor.submit(buildPath, i, len(allPaths), paths, logfile, cfg, client): paths for i, paths in enumerate(allPaths, 1)}
+                        for future in as_completed(futures):
+                            try:
+                                future.result()
+                            except Exception as e:
+                                print(f"Error processing {futures[future]['source_path']}: {e}")
+                else:
+                    for i, paths in enumerate(allPaths, 1):
+                        buildPath(i, len(allPaths), paths, logfile, cfg, client)
+        finally:
+            sys.stdout = stdout
+
+        #persist the processed-book index
+        myx_utilities.saveBookIndex(cfg)
+        myx_library.saveLibraries()
+        myx_authors.saveAliases()
+
+        #lookups the confidence tiers made unnecessary
+        counters = myx_perf.report()["counters"]
+        tiers = {t: counters.get(f"confidence {t}", 0) for t in ["asin agreement", "asin", "high", "low"]}
+        if sum(tiers.values()):
+            print(f"\nConfidence: {tiers['asin agreement']} ASIN agreement, {tiers['asin']} ASIN, {tiers['high']} high, {tiers['low']} low. Saved {counters.get('saved audible searches', 0)} Audible searches and {counters.get('saved goodreads lookups', 0)} Goodreads lookups")
+
+        #offline lookups that weren't in the cache
+        if bool(cfg.get("Config/flags/offline")):
+            misses = myx_utilities.getOfflineMisses()
+            details = ", ".join([f"{category} {n}" for category, n in sorted(misses.items())])
+            print(f"\nOffline run: {sum(misses.values())} lookups were not in the cache{f' ({details})' if len(details) else ''}")
+    finally:
+        myx_perf.stopProfile(logfile.replace(".csv", ""))
+
+    #where did the time go
+    elapsed = time.perf_counter() - start
+    myx_perf.printReport(elapsed)
+    if perfReport:
+        myx_perf.writeReport(logfile.replace(".csv", "_perf.json"), elapsed)
 
 if __name__ == "__main__":
     
@@ -361,6 +679,7 @@ if __name__ == "__main__":
         os.makedirs(os.path.join(os.getcwd(), "__cache__", "book"), exist_ok=True)
         os.makedirs(os.path.join(os.getcwd(), "__cache__", "mam"), exist_ok=True)
         os.makedirs(os.path.join(os.getcwd(), "__cache__", "audible"), exist_ok=True)
+        os.makedirs(os.path.join(os.getcwd(), "__cache__", "goodreads"), exist_ok=True)
 
         #process commandline arguments
         myx_args.params = myx_args.importArgs()
@@ -11,63 +11,107 @@ from selenium.webdriver.chrome.options import Options
 from webdriver_manager.chrome import ChromeDriverManager
 from selenium.webdriver.common.action_chains import ActionChains
 import myx_classes
+import myx_utilities
 import time
 import search
+import myx_perf
 
 @dataclass
 class Goodreads:
     driver: webdriver
+    cfg: dict
     genre_limit: int = 2
     xpath_close: str = "//button[@aria-label='Close']"
     xpath_show_all: str = "//button[@aria-label='Show all items in the list']"
     xpath_book_details: str = "//button[@aria-label='Book details and editions']"
     
-    def __init__(self):
-        self.driver=self.start_webdriver(True)
+    def __init__(self, cfg=None):
+        self.cfg=cfg
+        # the webdriver is only started for the first book page that isn't cached
+        self.driver=None
 
+    def get_driver(self):
+        if self.driver is None:
+            self.driver=self.start_webdriver(True)
+        return self.driver
+
+    @myx_perf.timed("goodreads")
     def fetch_all(self, book, isbn="", title="", author=""):
+        # the parsed metadata is cached per search, so reruns don't need the search engine or the webdriver
+        cacheKey = myx_utilities.getHash(f"goodreads:{isbn}{title}{author}")
         try:
-            # instantiate our search class and search for the book url
-            url = search.Search()
-            url.search(isbn, title, author)
+            if (self.cfg is not None) and myx_utilities.isCached(cacheKey, "goodreads", self.cfg):
+                return self.set_metadata(book, myx_utilities.loadFromCache(cacheKey, "goodreads", self.cfg))
+
+            if myx_utilities.isOffline(self.cfg):
+                myx_utilities.offlineMiss("goodreads")
+                return book
 
-            if url.book_url:
+            # a stale entry already knows its book page, ask Goodreads if it changed before scraping it again
+            # only an entry with validators is asked, without them the answer is the full page, which is scraped anyway
+            response = None
+            meta = myx_utilities.readCacheMeta(cacheKey, "goodreads") if self.cfg is not None else {}
+            book_url = meta.get("url", "")
+            if book_url and (("etag" in meta) or ("last_modified" in meta)):
+                response = myx_utilities.revalidatingGet(httpx, self.cfg, "goodreads", cacheKey, "goodreads", book_url, headers=search.Search().headers, follow_redirects=True)
+                if response is None:
+                    return self.set_metadata(book, myx_utilities.loadFromCache(cacheKey, "goodreads", self.cfg))
+            elif not book_url:
+                # instantiate our search class and search for the book url
+                url = search.Search(cfg=self.cfg)
+                url.search(isbn, title, author)
+                book_url = url.book_url
+
+            if book_url:
                 # get the HTML for the book page
-                page = self.get_book_page_content(url.book_url, self.driver)
+                page = self.get_book_page_content(book_url, self.get_driver())
 
                 if page:
-                    # parse for the original publication year
-                    book.publication_year = self.get_original_publication_year(page)
-
-                    # parse for the description
-                    book.description = self.get_description(page)
-
-                    # parse for the genres. the get_genres method returns a list, so we convert the list into a CSV string
-                    categories = ','.join(self.get_genres(page))
-
-                    # use the categories data to set the genres
-                    book.setGenres(categories)
-
-                    # use the categories data to set the tags
-                    book.setTags(categories)
-
-                    # parse for the series
-                    series = self.get_series(page)
-                    
-                    book.series.clear()
-                    if series:
-                        for name, part in series.items():
-                            book.series.append(myx_classes.Series(name, part))
-
-                    # parse for the publisher
-                    book.publisher = self.get_publisher(page)
-
-                    # parse for the ISBN
-                    book.isbn = self.get_isbn(page)
+                    metadata = self.get_metadata(page)
+                    if self.cfg is not None:
+                        myx_utilities.cacheMe(cacheKey, "goodreads", metadata, self.cfg, response, url=book_url)
+                    self.set_metadata(book, metadata)
+                else:
+                    # the page couldn't be loaded, the stale metadata is better than none
+                    stale = myx_utilities.loadStale(cacheKey, "goodreads", self.cfg)
+                    if stale is not None:
+                        self.set_metadata(book, stale)
 
                 return book
         except Exception as e:
             print("Encountered an issue fetching Goodreads metadata")
+            stale = myx_utilities.loadStale(cacheKey, "goodreads", self.cfg)
+            if stale is not None:
+                return self.set_metadata(book, stale)
+
+    def get_metadata(self, page):
+        # parse for the genres. the get_genres method returns a list, so we convert the list into a CSV string
+        return {
+            "publication_year": self.get_original_publication_year(page),
+            "description": self.get_description(page),
+            "categories": ','.join(self.get_genres(page) or []),
+            "series": self.get_series(page),
+            "publisher": self.get_publisher(page),
+            "isbn": self.get_isbn(page)
+        }
+
+    def set_metadata(self, book, metadata):
+        # original publication year and description
+        book.publication_year = metadata["publication_year"]
+        book.description = metadata["description"]
+
+        # use the categories data to set the genres and the tags
+        book.setGenres(metadata["categories"])
+        book.setTags(metadata["categories"])
+
+        book.series.clear()
+        if metadata["series"]:
+            for name, part in metadata["series"].items():
+                book.series.append(myx_classes.Series(name, part))
+
+        book.publisher = metadata["publisher"]
+        book.isbn = metadata["isbn"]
+        return book
 
     def start_webdriver(self, headless):
         try:    
@@ -87,6 +131,10 @@ class Goodreads:
             print(f"Error occurred while instantiating webdriver {e}")
 
     def stop_webdriver(self, driver):
+        # nothing to stop if every page came from the cache
+        if driver is None:
+            return
+
         try:
             driver.quit()
         except Exception as e:
@@ -109,6 +157,9 @@ class Goodreads:
         # Before we parse the page HTML, we must click a few buttons to load all the metadata.
         
         try:
+            myx_perf.count("network goodreads")
+            myx_utilities.throttle("goodreads")
+            driver.set_page_load_timeout(sum(myx_utilities.getTimeout(self.cfg)))
             driver.get(book_url)
             
             # Dismiss the sign-in modal
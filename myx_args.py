@@ -6,6 +6,27 @@ from pprint import pprint
 #Module Variables
 params:any
 
+def shardArg(value):
+    #i/N, the i-th of N shards
+    try:
+        index, count = [int(v) for v in value.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not a shard, use i/N, e.g. 1/4")
+    if (count < 1) or (index < 1) or (index > count):
+        raise argparse.ArgumentTypeError(f"{value} is not a shard, i must be between 1 and N")
+    return {"index": index, "count": count}
+
+def expandList(values):
+    #ASINs or authors given on the command line, a value that's a file adds one per line
+    items=[]
+    for value in values or []:
+        if os.path.isfile(value):
+            with open(value, mode='r', encoding='utf-8') as file:
+                items.extend([line.strip() for line in file if len(line.strip()) and not line.startswith("#")])
+        else:
+            items.append(value)
+    return items
+
 def importArgs():
     appDescription = """Reorganize your audiobooks using ID3 or Audbile metadata.\nThe originals are untouched and will be hardlinked to their destination"""
     parser = argparse.ArgumentParser(prog="booktree", description=appDescription)
@@ -20,6 +41,32 @@ def importArgs():
     parser.add_argument("--fixid3", default=None, action="store_true", help="If provided, will attempt to fix id3 metadata")
     parser.add_argument("--ebooks", default=None, action="store_true", help="If provided, will look for ebooks and skip audible")
     parser.add_argument("--add-narrators", default=None, action="store_true", help="If provided,include the narrators in the path")
+    parser.add_argument("--no-catalog", default=None, action="store_true", help="If provided, skips the local Audible catalog and always searches Audible")
+    parser.add_argument("--offline", default=None, action="store_true", help="If provided, answers every MAM, Audible and Goodreads lookup from the cache, a cache miss is treated as no result")
+    parser.add_argument("--path-workers", default=None, type=int, metavar="N", help="If provided, processes up to N of the configured paths at the same time")
+    parser.add_argument("--search-parallel", default=None, type=int, metavar="K", help="If provided, runs up to K of a book's author/narrator Audible searches at the same time, the default of 1 searches them one by one")
+    parser.add_argument("--book-budget", default=None, type=float, metavar="SECONDS", help="If provided, gives up on a book's remaining MAM, Audible and Goodreads lookups after this many seconds")
+    parser.add_argument("--hedge", default=None, action="store_true", help="If provided, sends a duplicate Audible or search request when the first one is slower than the recent p95 latency")
+    parser.add_argument("--shard", default=None, type=shardArg, metavar="i/N", help="If provided, only processes the i-th of N deterministic shards of the books, e.g. 1/4")
+    parser.add_argument("--merge-logs", default=None, nargs="+", metavar="LOG", help="If provided, merges these logs (e.g. the logs of every shard) into one and exits")
+    parser.add_argument("--coordinator", default=None, action="store_true", help="If provided, probes the books and queues them for --worker processes, then creates the hardlinks")
+    parser.add_argument("--worker", default=None, action="store_true", help="If provided, matches books from the coordinator's queue until it stays empty")
+    parser.add_argument("--consolidate-authors", default=None, action="store_true", help="If provided, merges author folders in your media paths that are the same author spelled differently, and exits")
+    parser.add_argument("--perf-report", default=None, action="store_true", help="If provided, saves the per-stage performance report as JSON next to the log")
+    parser.add_argument("--profile", default=None, nargs="?", const="cprofile", choices=["cprofile", "sample"], help="If provided, profiles the run with cProfile (default) or a sampling profiler, output is saved next to the log")
+    parser.add_argument("--profile-stages", default=None, nargs="+", metavar="STAGE", help="If provided, only profiles these stages, e.g. \"fuzzy scoring\" \"mam search\"")
+
+    #Subcommands
+    subparsers = parser.add_subparsers(dest="command", metavar="command")
+    warm = subparsers.add_parser("warm", help="Fills the MAM, Audible and Goodreads caches ahead of a big import, without creating any links")
+    warm.add_argument("--source", default=None, nargs="+", metavar="PATH", help="Warms the lookups of the books in these source paths, defaults to the configured source paths")
+    warm.add_argument("--asins", default=None, nargs="+", metavar="ASIN", help="Warms these ASINs, or the ASINs listed in these files (one per line)")
+    warm.add_argument("--authors", default=None, nargs="+", metavar="AUTHOR", help="Warms the Audible catalog of these authors, or of the authors listed in these files (one per line)")
+    warm.add_argument("--rate", default=None, type=float, metavar="R", help="Sends at most R requests per second to each service")
+    cache = subparsers.add_parser("cache", help="Cache maintenance: statistics, integrity check, compaction and migration between backends")
+    cache.add_argument("action", choices=["stats", "verify", "compact", "migrate"], help="stats: size and age per category, verify: removes corrupt entries, compact: upgrades old formats, shares duplicates and vacuums, migrate: copies the cache to another backend")
+    cache.add_argument("--to", default=None, choices=["files", "sqlite"], help="The backend to migrate to")
+    cache.add_argument("--prune", default=None, action="store_true", help="If provided, removes the migrated entries from the old backend")
 
     # #you want a specific file or pattern
     # parser.add_argument("--file", default="", help="The file or files(s) you want to process.  Accepts * and ?. Defaults to *.m4b/*.mp3")
@@ -96,6 +143,63 @@ class Config(object):
                 if params.add_narrators is not None:
                     cfg["Config"]["flags"]["add_narrators"] = bool(params.add_narrators)   
 
+                if params.no_catalog is not None:
+                    cfg["Config"]["flags"]["no_catalog"] = bool(params.no_catalog)
+
+                if params.offline is not None:
+                    cfg["Config"]["flags"]["offline"] = bool(params.offline)
+
+                if params.path_workers is not None:
+                    cfg["Config"].setdefault("concurrency", {})["paths"] = params.path_workers
+
+                if params.search_parallel is not None:
+                    cfg["Config"].setdefault("search", {})["parallel"] = params.search_parallel
+
+                if params.book_budget is not None:
+                    cfg["Config"].setdefault("timeouts", {})["book_seconds"] = params.book_budget
+
+                if params.hedge is not None:
+                    cfg["Config"].setdefault("hedge", {})["services"] = ["audible", "search"]
+
+                if params.shard is not None:
+                    cfg["Config"]["shard"] = params.shard
+
+                if params.merge_logs is not None:
+                    cfg["Config"]["merge_logs"] = params.merge_logs
+
+                if params.coordinator:
+                    cfg["Config"].setdefault("queue", {})["role"] = "coordinator"
+
+                if params.worker:
+                    cfg["Config"].setdefault("queue", {})["role"] = "worker"
+
+                if params.consolidate_authors is not None:
+                    cfg["Config"]["consolidate_authors"] = bool(params.consolidate_authors)
+
+                if getattr(params, "command", None) == "warm":
+                    cfg["Config"]["warm"] = {"enabled": True, "sources": params.source or [], "asins": expandList(params.asins), "authors": expandList(params.authors)}
+                    if params.rate is not None:
+                        #--rate only lowers a configured limit, a service without one (or with 0, no limit) gets R
+                        limits = cfg["Config"].get("rate_limit", {}) or {}
+                        for service in ["audible", "mam", "search", "goodreads"]:
+                            configured = float(limits.get(service, 0) or 0)
+                            limits[service] = min(configured, params.rate) if configured > 0 else params.rate
+                        cfg["Config"]["rate_limit"] = limits
+
+                if getattr(params, "command", None) == "cache":
+                    if (params.action == "migrate") and (params.to is None):
+                        raise Exception("cache migrate needs --to files or --to sqlite")
+                    cfg["Config"]["cache_maintenance"] = {"action": params.action, "target": params.to, "prune": bool(params.prune)}
+
+                if params.perf_report is not None:
+                    cfg["Config"]["flags"]["perf_report"] = bool(params.perf_report)
+
+                if params.profile is not None:
+                    cfg["Config"].setdefault("profile", {})["mode"] = params.profile
+
+                if params.profile_stages is not None:
+                    cfg["Config"].setdefault("profile", {})["stages"] = params.profile_stages
+
             self._data = cfg            
         except Exception as e:
             raise Exception(e)
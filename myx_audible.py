@@ -2,29 +2,321 @@ import os, sys, subprocess, shlex, re
 from subprocess import call
 from pprint import pprint
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import myx_utilities
 import myx_classes
+import myx_catalog
+import myx_authors
+import myx_perf
 
+#Module variables, Audible catalog API
+audible_api="https://api.audible.com"
+
+#Module variables, ASINs waiting to be resolved and the products they resolved to (None if Audible doesn't have it)
+pendingAsins=[]
+resolvedAsins={}
+asinLock=threading.Lock()
+
+def queueAsin(asin):
+    #collect an ASIN to be resolved in the next batch
+    asin = str(asin).strip()
+    with asinLock:
+        if len(asin) and (asin not in resolvedAsins) and (asin not in pendingAsins):
+            pendingAsins.append(asin)
+
+@myx_perf.timed("audible asin batch")
+def resolveAsins(client, cfg, batchSize=50):
+    #resolve all pending ASINs with as few multi-ASIN catalog requests as possible
+    verbose = bool(cfg.get("Config/flags/verbose"))
+    no_catalog = bool(cfg.get("Config/flags/no_catalog"))
+
+    #take everything queued so far, concurrent paths may be queueing more
+    with asinLock:
+        queued = list(pendingAsins)
+        pendingAsins.clear()
+
+    #the local catalog already knows some of them
+    asins=[]
+    for asin in queued:
+        product = myx_catalog.getProduct(asin) if not no_catalog else None
+        if product is not None:
+            resolvedAsins[asin] = product
+        else:
+            asins.append(asin)
+
+    #offline, the rest are looked up one by one from the audible cache
+    if myx_utilities.isOffline(cfg):
+        return 0
+
+    if len(asins):
+        print (f"Resolving {len(asins)} ASINs from Audible in batches of {batchSize}")
+
+    for i in range(0, len(asins), batchSize):
+        batch = asins[i:i+batchSize]
+        try:
+            r = myx_utilities.httpGet (client, cfg, "audible",
+                f"{audible_api}/1.0/catalog/products",
+                params={
+                    "asins": ",".join(batch),
+                    "response_groups": (
+                        "series, product_attrs, relationships, contributors, product_desc, product_extended_attrs"
+                    )
+                },
+            )
+
+            r.raise_for_status()
+            products = compactResponse(r.json()).get("products", [])
+        except Exception as e:
+            #leave them unresolved, they'll be looked up one by one
+            print(f"Error resolving ASINs from audible: {e}")
+            continue
+
+        for asin in batch:
+            resolvedAsins[asin] = None
+        for product in products:
+            #Audible returns a stub (without a title) for ASINs it doesn't know
+            if ("asin" in product) and ("title" in product):
+                resolvedAsins[str(product["asin"])] = product
+                myx_catalog.addProduct(product)
+
+        if verbose:
+            print (f"Resolved {len(products)} of {len(batch)} ASINs")
+
+    return len(asins)
+
+def isAsinResolved(asin):
+    return (len(asin) > 0) and (asin in resolvedAsins)
+
+def getResolvedBooks(asin, language="english"):
+    #returns the resolved product for this ASIN, in the same form as getAudibleBook
+    if resolvedAsins.get(asin) is not None:
+        return filterLanguage([resolvedAsins[asin]], language)
+    return []
+
+def filterLanguage(products, language="english"):
+    #other language editions are ignored, the same way getAudibleBook ignores them
+    return [p for p in products if ("language" in p) and (p["language"] == language)]
+
+#Module variables, prefetched author catalogs {author key: [products]}
+authorCatalogs={}
+
+@myx_perf.timed("audible prefetch")
+def prefetchAuthors(client, cfg, books):
+    #fetch the whole Audible catalog of every author with enough pending books, once
+    minBooks = int(cfg.get("Config/prefetch/min_books", 3))
+    maxPages = int(cfg.get("Config/prefetch/max_pages", 10))
+
+    #with --no-catalog getAudibleBooks never looks at the prefetched catalogs
+    if (minBooks <= 0) or bool(cfg.get("Config/flags/no_catalog")):
+        return 0
+
+    #group the pending books by their normalized primary author
+    authors={}
+    for book in books:
+        if (book is None) or (len(book.authors) == 0) or myx_utilities.isGraphicAudio(book.authors[0].name):
+            continue
+        key = myx_authors.getAuthorKey(book.authors[0].name)
+        if len(key):
+            authors.setdefault(key, [book.authors[0].name, 0])
+            authors[key][1] += 1
+
+    prolific = [(key, a[0]) for key, a in authors.items() if (a[1] >= minBooks) and (key not in authorCatalogs)]
+    if len(prolific):
+        print (f"Prefetching the Audible catalog of {len(prolific)} authors with {minBooks} or more books")
+
+    for key, author in prolific:
+        authorCatalogs[key] = getAuthorCatalog(client, cfg, myx_utilities.cleanseAuthor(author), maxPages=maxPages)
+
+    return len(prolific)
+
+def getAuthorCatalog(client, cfg, author, pageSize=50, maxPages=10):
+    #all of an author's products, one page at a time
+    verbose = bool(cfg.get("Config/flags/verbose"))
+
+    products=[]
+    for page in range(1, maxPages+1):
+        cacheKey = myx_utilities.getHash(f"author:{author}:{pageSize}:{page}")
+
+        def fetch():
+            if myx_utilities.isCached(cacheKey, "audible", cfg):
+                return myx_utilities.loadFromCache(cacheKey, "audible", cfg, compactResponse)
+
+            if myx_utilities.isOffline(cfg):
+                myx_utilities.offlineMiss("audible")
+                return {}
+
+            response={}
+            try:
+                #a stale page is revalidated, if Audible says it hasn't changed the cached page is still good
+                r = myx_utilities.revalidatingGet (client, cfg, "audible", cacheKey, "audible",
+                    f"{audible_api}/1.0/catalog/products",
+                    params={
+                        "author": author,
+                        "num_results": pageSize,
+                        "page": page,
+                        "products_sort_by": "Relevance",
+                        "response_groups": (
+                            "series, product_attrs, relationships, contributors, product_desc, product_extended_attrs"
+                        )
+                    },
+                )
+                if r is None:
+                    return myx_utilities.loadFromCache(cacheKey, "audible", cfg, compactResponse)
+
+                r.raise_for_status()
+                response = compactResponse(r.json())
+
+                #cache this page
+                myx_utilities.cacheMe(cacheKey, "audible", response, cfg, r)
+
+            except Exception as e:
+                print(f"Error fetching {author}'s catalog from audible: {e}")
+                response = myx_utilities.loadStale(cacheKey, "audible", cfg, compactResponse) or response
+
+            return response
+
+        batch = myx_utilities.singleFlight(cacheKey, "audible", fetch).get("products", [])
+        for product in batch:
+            myx_catalog.addProduct(product)
+        products.extend(batch)
+
+        if (len(batch) < pageSize):
+            break
+
+    if verbose:
+        print (f"Prefetched {len(products)} products for {author}")
+
+    return products
+
+def getAuthorBooks(author, language="english"):
+    #returns the prefetched products of this author, in the same form as getAudibleBook
+    products = authorCatalogs.get(myx_authors.getAuthorKey(author), [])
+    return [p for p in products if ("language" in p) and (p["language"] == language)]
+
+def getAudibleProduct(client, cfg, asin, language="english"):
+    #one product by ASIN in this language, from the batch, the local catalog or a single ASIN fetch
+    if isAsinResolved(asin):
+        return getResolvedBooks(asin, language)
+
+    if not bool(cfg.get("Config/flags/no_catalog")):
+        product = myx_catalog.getProduct(asin)
+        if product is not None:
+            return filterLanguage([product], language)
+
+    return filterLanguage(getAudibleBook(client, cfg, asin=asin, language=language), language)
+
+def planSearches(authors, narrators):
+    #author/narrator combinations, most likely first: the primary author and narrator, then the alternates in turn
+    plan=[]
+    for i, author in enumerate(authors):
+        for j, narrator in enumerate(narrators if len(narrators) else [""]):
+            combo = (myx_utilities.cleanseAuthor(author), myx_utilities.cleanseAuthor(narrator))
+            if len(combo[0]):
+                plan.append((i + j, i, combo))
+
+    plan.sort(key=lambda p: (p[0], p[1]))
+    combos=[]
+    for p in plan:
+        if p[2] not in combos:
+            combos.append(p[2])
+    return combos
+
+def searchPlan(client, cfg, combos, asin="", title="", keywords="", language="english", speculative=False):
+    #run the author/narrator searches a few at a time, the best ranked search that finds products wins
+    #searches that haven't started once a winner is known are cancelled, the keyword search is the fallback
+    parallel = max(1, int(cfg.get("Config/search/parallel", 1)))
+
+    def search(authors="", narrators="", keywords=""):
+        return getAudibleBook(client, cfg, asin=asin, title=title, authors=authors, narrators=narrators, keywords=keywords, language=language)
+
+    #one at a time, the original behaviour
+    if (parallel == 1) or (len(combos) + int(speculative) <= 1):
+        for author, narrator in combos:
+            books = search(author, narrator, keywords)
+            if len(books):
+                return books
+        return getAudibleBook(client, cfg, keywords=keywords, language=language)
+
+    executor = ThreadPoolExecutor(max_workers=parallel + int(speculative), thread_name_prefix="booktree-search")
+    try:
+        #the keyword search runs alongside when the id3 data is too weak to trust the combinations
+        keywordSearch = None
+        if speculative:
+            keywordSearch = executor.submit(myx_utilities.withThreadContext(getAudibleBook), client, cfg, keywords=keywords, language=language)
+            myx_perf.count("audible speculative keyword searches")
+
+        running={}
+        results={}
+        queued = list(enumerate(combos))
+        winner = None
+        while True:
+            #keep up to parallel searches in flight, none once a better ranked search has found products
+            while len(queued) and (len(running) < parallel) and ((winner is None) or (queued[0][0] < winner)):
+                rank, (author, narrator) = queued.pop(0)
+                running[executor.submit(myx_utilities.withThreadContext(search), author, narrator, keywords)] = rank
+
+            if len(running) == 0:
+                break
+
+            done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+            for future in done:
+                rank = running.pop(future)
+                try:
+                    results[rank] = future.result()
+                except Exception as e:
+                    print(f"Error searching audible: {e}")
+                    results[rank] = []
+                if len(results[rank]) and ((winner is None) or (rank < winner)):
+                    winner = rank
+
+            #a winner only has to wait for the better ranked searches still in flight
+            if winner is not None:
+                for future in [f for f, r in running.items() if r > winner]:
+                    running.pop(future)
+                    if future.cancel():
+                        myx_perf.count("audible searches cancelled")
+
+        if len(queued):
+            myx_perf.count("audible searches cancelled", len(queued))
+        if winner is not None:
+            if keywordSearch is not None and keywordSearch.cancel():
+                myx_perf.count("audible searches cancelled")
+            return results[winner]
+
+        if keywordSearch is not None:
+            return keywordSearch.result()
+        return getAudibleBook(client, cfg, keywords=keywords, language=language)
+    finally:
+        #searches already in flight finish on their own and fill the cache
+        executor.shutdown(wait=False, cancel_futures=True)
+
+@myx_perf.timed("audible search")
 def getAudibleBook(client, cfg, asin="", title="", authors="", narrators="", keywords="", language="english"):
     print (f"Searching Audible for\n\tasin:{asin}\n\ttitle:{title}\n\tauthors:{authors}\n\tnarrators:{narrators}\n\tkeywords:{keywords}")
 
     enBooks=[]
     cacheKey = myx_utilities.getHash(f"{asin}{title}{authors}{narrators}{keywords}")
-    books={}
-    if myx_utilities.isCached(cacheKey, "audible", cfg):
-        print (f"Retrieving {cacheKey} from audible")
+    def fetch():
+        if myx_utilities.isCached(cacheKey, "audible", cfg):
+            print (f"Retrieving {cacheKey} from audible")
 
-        #this search has been done before, retrieve the results
-        books = myx_utilities.loadFromCache(cacheKey, "audible")
+            #this search has been done before, retrieve the results
+            return myx_utilities.loadFromCache(cacheKey, "audible", cfg, compactResponse)
 
-    else:
+        if myx_utilities.isOffline(cfg):
+            myx_utilities.offlineMiss("audible")
+            return {}
+
+        books={}
         try:
             if len(asin) : 
-                p=f"https://api.audible.com/1.0/catalog/products/{asin}"
+                p=f"{audible_api}/1.0/catalog/products/{asin}"
             else:
-                p=f"https://api.audible.com/1.0/catalog/products"
+                p=f"{audible_api}/1.0/catalog/products"
 
-            r = client.get (
+            #a stale search is revalidated, if Audible says it hasn't changed the cached results are still good
+            r = myx_utilities.revalidatingGet (client, cfg, "audible", cacheKey, "audible",
                 p,
                 params={
                     "asin": asin,
@@ -38,17 +330,24 @@ def getAudibleBook(client, cfg, asin="", title="", authors="", narrators="", key
                     )
                 },
             )
+            if r is None:
+                return myx_utilities.loadFromCache(cacheKey, "audible", cfg, compactResponse)
 
             r.raise_for_status()
-            books = r.json()
+            books = compactResponse(r.json())
 
             #cache this results
-            myx_utilities.cacheMe(cacheKey, "audible", books, cfg)
+            myx_utilities.cacheMe(cacheKey, "audible", books, cfg, r)
 
         except Exception as e:
                 print(f"Error searching audible: {e}")
+                books = myx_utilities.loadStale(cacheKey, "audible", cfg, compactResponse) or books
+
+        return books
+
+    #identical searches running at the same time share one request
+    books = myx_utilities.singleFlight(cacheKey, "audible", fetch)
 
-    
     #check for ["product"] or ["products"]
     if "product" in books.keys():
         enBooks.append(books["product"])
@@ -64,7 +363,7 @@ def getBookByAsin(client, asin):
     print ("getBookByASIN: ", asin)
     try:
         r = client.get (
-            f"https://api.audible.com/1.0/catalog/products/{asin}",
+            f"{audible_api}/1.0/catalog/products/{asin}",
             params={
                 "response_groups": (
                     "series, product_attrs, relationships, contributors, product_desc, product_extended_attrs"
@@ -83,7 +382,7 @@ def getBookByAuthorTitle(client, author, title, language="english"):
     enBooks=[]
     try:
         r = client.get (
-            f"https://api.audible.com/1.0/catalog/products",
+            f"{audible_api}/1.0/catalog/products",
             params={
                 "author": myx_utilities.strip_accents(author),
                 "title": title,
@@ -107,9 +406,36 @@ def getBookByAuthorTitle(client, author, title, language="english"):
     except Exception as e:
         print(e)
 
+def compactProduct(product):
+    #keep only what product2Book reads
+    compact={}
+    for k in ["asin", "title", "subtitle", "publisher_summary", "runtime_length_min", "publication_name", "language"]:
+        if k in product:
+            compact[k] = product[k]
+    for k in ["authors", "narrators"]:
+        if k in product:
+            compact[k] = [{"name": c["name"]} for c in product[k]]
+    if "series" in product:
+        compact["series"] = [{"title": s["title"], "sequence": s.get("sequence", "")} for s in product["series"]]
+
+    return compact
+
+def compactResponse(response):
+    #compact an Audible catalog response, keeping its product/products shape
+    compact={}
+    if "product" in response:
+        compact["product"] = compactProduct(response["product"])
+    if "products" in response:
+        compact["products"] = [compactProduct(p) for p in response["products"]]
+
+    return compact
+
 def product2Book(product):
     #product is an Audible product json
     if product is not None:
+        #keep a normalized copy in the local catalog, so other searches can find it
+        myx_catalog.addProduct(product)
+
         book=myx_classes.Book()
         if 'asin' in product: book.asin=str(product["asin"])
         if 'title' in product: book.title=str(product["title"])
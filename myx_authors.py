@@ -0,0 +1,179 @@
+from dataclasses import dataclass
+import os, re
+import json
+import threading
+from thefuzz import fuzz
+import myx_utilities
+
+#Module variables
+aliasFile=os.path.join("__cache__", "authors.json")
+#alias key: canonical key, learned from ASIN matches or set in Config/author_aliases
+aliases={}
+#alias key: canonical key, only the ones set in Config/author_aliases
+configured={}
+aliasesLoaded=False
+aliasesChanged=False
+lock=threading.Lock()
+#author name: AuthorIdentity, the same names show up on thousands of books and candidates
+identities={}
+
+#Author Identity, every normalized form of an author's name
+@dataclass(slots=True, frozen=True)
+class AuthorIdentity:
+    #the name without accents, punctuation, spaces or case, "Last, First" as "First Last", plus its alias
+    keys:frozenset
+    #initials and last name, when the given names are initials (J.R.R. Tolkien)
+    abbreviated:frozenset
+    #initials and last name, when the given names are spelled out (John Ronald Reuel Tolkien)
+    expanded:frozenset
+
+def getTokens(name):
+    #lower case words of the cleansed name, GraphicAudio is not an author
+    name = re.sub(r"graphic[\s]?audio[\s]?(llc[.]?)*", " ", str(name), flags=re.IGNORECASE)
+    name = re.sub(r"[\(\[].*?[\)\]]", " ", name)
+    clean = myx_utilities.cleanseAuthor(name).lower()
+
+    parts = [p.strip() for p in clean.split(",") if len(p.strip())]
+    if len(parts) == 2:
+        clean = f"{parts[1]} {parts[0]}"
+
+    return re.findall(r"\w+", clean)
+
+def loadAliases(cfg=None):
+    #learned aliases from the cache, plus the ones in the config
+    global aliasesLoaded
+    with lock:
+        if not aliasesLoaded:
+            aliasesLoaded = True
+            try:
+                with open(os.path.join(os.getcwd(), aliasFile), mode='r', encoding='utf-8') as file:
+                    aliases.update(json.loads(file.read()))
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print (f"Unable to read the author aliases {aliasFile}: {e}")
+
+        if cfg is not None:
+            for alias, author in (cfg.get("Config/author_aliases", {}) or {}).items():
+                alias, author = "".join(getTokens(alias)), "".join(getTokens(author))
+                if len(alias) and len(author) and (alias != author):
+                    aliases[alias] = author
+                    configured[alias] = author
+        identities.clear()
+
+def saveAliases():
+    #write the learned aliases, merged with what other processes learned since
+    if not aliasesChanged:
+        return
+
+    aliasPath = os.path.join(os.getcwd(), aliasFile)
+    with lock:
+        merged = {}
+        try:
+            with open(aliasPath, mode='r', encoding='utf-8') as file:
+                merged = json.loads(file.read())
+        except Exception:
+            pass
+        merged.update(aliases)
+
+        os.makedirs(os.path.dirname(aliasPath), exist_ok=True)
+        tmpFile = f"{aliasPath}.{os.getpid()}.tmp"
+        with open(tmpFile, mode="w", encoding='utf-8') as file:
+            file.write(json.dumps(merged))
+        os.replace(tmpFile, aliasPath)
+
+def resolveAlias(key, learned=True):
+    #follow the aliases to the canonical key, learned=False only follows the configured ones
+    if not aliasesLoaded:
+        loadAliases()
+    table = aliases if learned else configured
+    seen = set()
+    while (key in table) and (key not in seen):
+        seen.add(key)
+        key = table[key]
+    return key
+
+def getAuthorKey(name, learned=True):
+    #canonical key of an author, empty if the name isn't an author
+    tokens = getTokens(name)
+    return resolveAlias("".join(tokens), learned) if len(tokens) else ""
+
+def namesAgree(name, other):
+    #two spellings of the same full name: similar surnames and given names, initials are ambiguous and never agree
+    tokens, others = getTokens(name), getTokens(other)
+    if (len(tokens) < 2) or (len(tokens) != len(others)):
+        return False
+    if any([len(t) == 1 for t in tokens[:-1] + others[:-1]]):
+        return False
+
+    for token, otherToken in zip(tokens, others):
+        if (token != otherToken) and ((token[0] != otherToken[0]) or (fuzz.ratio(token, otherToken) < 85)):
+            return False
+    return True
+
+def isSameAuthor(name, other):
+    #same key without the learned aliases, or a learned alias backed by the names themselves
+    key = getAuthorKey(name, learned=False)
+    if len(key) and (key == getAuthorKey(other, learned=False)):
+        return True
+    return (getAuthorKey(name) == getAuthorKey(other)) and namesAgree(name, other)
+
+def getAuthorIdentity(name):
+    identity = identities.get(name)
+    if identity is None:
+        identity = buildIdentity(name)
+        identities[name] = identity
+    return identity
+
+def buildIdentity(name):
+    tokens = getTokens(name)
+    if len(tokens) == 0:
+        return AuthorIdentity(frozenset(), frozenset(), frozenset())
+
+    key = "".join(tokens)
+    keys = {key, resolveAlias(key)}
+    abbreviated, expanded = set(), set()
+    if len(tokens) > 1:
+        initials = "".join([t[0] for t in tokens[:-1]]) + tokens[-1]
+        if all([len(t) == 1 for t in tokens[:-1]]):
+            abbreviated.add(initials)
+        else:
+            expanded.add(initials)
+
+    return AuthorIdentity(frozenset(keys), frozenset(abbreviated), frozenset(expanded))
+
+def authorsMatch(authors, others):
+    #do these two lists of Contributors share an author, compared as set intersections
+    keys, abbreviated, expanded = set(), set(), set()
+    for author in authors:
+        identity = getAuthorIdentity(author.name)
+        keys |= identity.keys
+        abbreviated |= identity.abbreviated
+        expanded |= identity.expanded
+
+    for other in others:
+        identity = getAuthorIdentity(other.name)
+        if (identity.keys & keys) or (identity.abbreviated & expanded) or (identity.expanded & abbreviated):
+            return True
+
+    return False
+
+def learnAliases(authors, others):
+    #an accepted ASIN and title match says both lists are the same author, remember the other spelling
+    #only if the names themselves agree, a wrong ASIN tag must not turn one author into another
+    global aliasesChanged
+    if (len(authors) != 1) or (len(others) != 1) or authorsMatch(authors, others):
+        return False
+    if not namesAgree(authors[0].name, others[0].name):
+        return False
+
+    alias, author = getAuthorKey(authors[0].name), getAuthorKey(others[0].name)
+    if (len(alias) == 0) or (len(author) == 0) or (resolveAlias(author) == alias):
+        return False
+
+    with lock:
+        aliases[alias] = author
+        aliasesChanged = True
+        identities.clear()
+    print (f"Learned that {authors[0].name} is {others[0].name}")
+    return True
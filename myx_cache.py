@@ -0,0 +1,348 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+import statistics
+import myx_utilities
+
+#Module variables
+cacheFolder="__cache__"
+cacheFile=os.path.join(cacheFolder, "cache.db")
+#categories stored as cache entries, __cache__/library and the indexes are not
+categories=["book", "mam", "audible", "goodreads"]
+backendName="files"
+backends={}
+
+#Cache storage, every entry is a (category, key) with the encoded bytes and the time it was stored
+#an entry's age is what the TTLs and the revalidation look at, so moving an entry keeps its stored time
+class FilesBackend:
+    #one file per entry, __cache__/category/key, the stored time is the file's modification time
+    name = "files"
+
+    def getPath(self, category, key):
+        return os.path.join(os.getcwd(), cacheFolder, category, key)
+
+    def read(self, category, key, size=None):
+        #None if there's no entry
+        try:
+            with open(self.getPath(category, key), mode='rb') as file:
+                return file.read() if size is None else file.read(size)
+        except FileNotFoundError:
+            return None
+
+    def write(self, category, key, data, stored=None):
+        #write it to a temp file first so an interrupted write doesn't leave a truncated entry
+        bookFile = self.getPath(category, key)
+        tmpFile = f"{bookFile}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmpFile, mode="wb") as file:
+            file.write(data)
+        os.replace(tmpFile, bookFile)
+        if stored is not None:
+            os.utime(bookFile, (stored, stored))
+
+    def getStored(self, category, key):
+        try:
+            return os.stat(self.getPath(category, key)).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def touch(self, category, key, stored=None):
+        #an entry deduped into a hardlink shares its stored time with the other keys, it gets its own copy first
+        stored = time.time() if stored is None else stored
+        path = self.getPath(category, key)
+        if os.stat(path).st_nlink > 1:
+            with open(path, mode='rb') as file:
+                self.write(category, key, file.read(), stored)
+        else:
+            os.utime(path, (stored, stored))
+
+    def delete(self, category, key):
+        try:
+            os.remove(self.getPath(category, key))
+        except FileNotFoundError:
+            pass
+
+    def keys(self, category):
+        folder = os.path.join(os.getcwd(), cacheFolder, category)
+        if not os.path.exists(folder):
+            return
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.is_file() and not entry.name.endswith(".tmp"):
+                    yield entry.name
+
+    def scan(self, category):
+        #(key, size, stored) of every entry, without reading them
+        folder = os.path.join(os.getcwd(), cacheFolder, category)
+        if not os.path.exists(folder):
+            return
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.is_file() and not entry.name.endswith(".tmp"):
+                    stat = entry.stat()
+                    yield entry.name, stat.st_size, stat.st_mtime
+
+    def prepare(self, category):
+        os.makedirs(os.path.join(os.getcwd(), cacheFolder, category), exist_ok=True)
+
+    def removeLeftovers(self, category, dryRun=False):
+        #temp files of writes that were interrupted
+        folder = os.path.join(os.getcwd(), cacheFolder, category)
+        removed = 0
+        if os.path.exists(folder):
+            for name in os.listdir(folder):
+                if name.endswith(".tmp"):
+                    removed += 1
+                    if not dryRun:
+                        os.remove(os.path.join(folder, name))
+        return removed
+
+    def dedupe(self, category, dryRun=False):
+        #identical entries share one file (hardlinks), returns the bytes saved
+        seen = {}
+        saved = 0
+        for key, size, stored in list(self.scan(category)):
+            path = self.getPath(category, key)
+            with open(path, mode='rb') as file:
+                digest = hashlib.sha256(file.read()).hexdigest()
+            first = seen.setdefault(digest, path)
+            if (first == path) or os.path.samefile(first, path):
+                continue
+            saved += size
+            if not dryRun:
+                #the copy keeps its own stored time, hardlinks share one, keep the newer
+                newest = max(stored, os.stat(first).st_mtime)
+                tmpFile = f"{path}.{os.getpid()}.tmp"
+                os.link(first, tmpFile)
+                os.replace(tmpFile, path)
+                os.utime(path, (newest, newest))
+        return saved
+
+    def vacuum(self):
+        pass
+
+class SQLiteBackend:
+    #every entry in one table of __cache__/cache.db, for installs where millions of small files are slow
+    #the rollback journal (not WAL) is used, like the job queue, so workers on several hosts can share __cache__
+    name = "sqlite"
+
+    def __init__(self):
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def getConnection(self):
+        if self.connection is None:
+            dbFile = os.path.join(os.getcwd(), cacheFile)
+            os.makedirs(os.path.dirname(dbFile), exist_ok=True)
+            self.connection = sqlite3.connect(dbFile, timeout=60, check_same_thread=False, isolation_level=None)
+            self.connection.execute("PRAGMA journal_mode=DELETE")
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS entries (
+                                         category TEXT, key TEXT, data BLOB, stored REAL, PRIMARY KEY (category, key))""")
+        return self.connection
+
+    def read(self, category, key, size=None):
+        with self.lock:
+            if size is None:
+                row = self.getConnection().execute("SELECT data FROM entries WHERE category = ? AND key = ?", (category, key)).fetchone()
+            else:
+                row = self.getConnection().execute("SELECT substr(data, 1, ?) FROM entries WHERE category = ? AND key = ?", (size, category, key)).fetchone()
+        return None if row is None else bytes(row[0])
+
+    def write(self, category, key, data, stored=None):
+        stored = time.time() if stored is None else stored
+        with self.lock:
+            self.getConnection().execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)", (category, key, sqlite3.Binary(data), stored))
+
+    def getStored(self, category, key):
+        with self.lock:
+            row = self.getConnection().execute("SELECT stored FROM entries WHERE category = ? AND key = ?", (category, key)).fetchone()
+        return None if row is None else row[0]
+
+    def touch(self, category, key, stored=None):
+        stored = time.time() if stored is None else stored
+        with self.lock:
+            self.getConnection().execute("UPDATE entries SET stored = ? WHERE category = ? AND key = ?", (stored, category, key))
+
+    def delete(self, category, key):
+        with self.lock:
+            self.getConnection().execute("DELETE FROM entries WHERE category = ? AND key = ?", (category, key))
+
+    def keys(self, category):
+        for key, size, stored in self.scan(category):
+            yield key
+
+    def scan(self, category):
+        with self.lock:
+            rows = self.getConnection().execute("SELECT key, length(data), stored FROM entries WHERE category = ?", (category,)).fetchall()
+        for row in rows:
+            yield row
+
+    def prepare(self, category):
+        pass
+
+    def removeLeftovers(self, category, dryRun=False):
+        #a transaction is never left half written
+        return 0
+
+    def dedupe(self, category, dryRun=False):
+        #entries are rows, there's nothing to share
+        return 0
+
+    def vacuum(self):
+        with self.lock:
+            self.getConnection().execute("VACUUM")
+
+def getBackend(name=None):
+    name = backendName if name is None else name
+    if name not in backends:
+        if name == "sqlite":
+            backends[name] = SQLiteBackend()
+        elif name == "files":
+            backends[name] = FilesBackend()
+        else:
+            raise Exception(f"{name} is not a cache backend, use files or sqlite")
+    return backends[name]
+
+def setBackend(cfg):
+    #Config/cache/backend, files (default) or sqlite
+    global backendName
+    backendName = cfg.get("Config/cache/backend", "files") or "files"
+    getBackend()
+
+#Maintenance
+def getStats(cfg, backend=None):
+    #entries, size, age and format versions per category
+    backend = getBackend() if backend is None else backend
+    now = time.time()
+    stats = {}
+    for category in categories:
+        sizes, ages, versions = [], [], {}
+        stale = 0
+        for key, size, stored in backend.scan(category):
+            sizes.append(size)
+            ages.append((now - stored) / 86400)
+            stale += int(myx_utilities.isStale(stored, category, cfg))
+            header = backend.read(category, key, 4) or b""
+            version = header[3] if header.startswith(myx_utilities.cacheMagic) and (len(header) == 4) else 0
+            versions[version] = versions.get(version, 0) + 1
+
+        stats[category] = {"entries": len(sizes), "bytes": sum(sizes), "stale": stale, "versions": versions,
+                           "oldest_days": max(ages) if len(ages) else 0, "median_days": statistics.median(ages) if len(ages) else 0,
+                           "newest_days": min(ages) if len(ages) else 0}
+    return stats
+
+def printStats(stats, backend=None):
+    backend = getBackend() if backend is None else backend
+    print(f"\nCache statistics ({backend.name} backend)")
+    print(f"\t{'category':>10}  {'entries':>9}  {'size':>10}  {'stale':>7}  {'oldest':>8}  {'median':>8}  {'newest':>8}  versions")
+    for category, s in stats.items():
+        versions = ", ".join([f"v{v}: {n}" for v, n in sorted(s["versions"].items())])
+        print(f"\t{category:>10}  {s['entries']:>9}  {s['bytes'] / 1048576:>8.1f}MB  {s['stale']:>7}  {s['oldest_days']:>7.0f}d  {s['median_days']:>7.0f}d  {s['newest_days']:>7.0f}d  {versions}")
+
+def isValid(data):
+    #an entry that can be decoded, a truncated write or a corrupt file can't
+    try:
+        myx_utilities.decodeCacheEntry(data)
+        return True
+    except Exception:
+        return False
+
+def verify(dryRun=False, backend=None):
+    #remove the entries that can't be decoded and the leftovers of interrupted writes
+    backend = getBackend() if backend is None else backend
+    removed = {}
+    for category in categories:
+        corrupt = 0
+        for key in list(backend.keys(category)):
+            data = backend.read(category, key)
+            if (data is not None) and not isValid(data):
+                corrupt += 1
+                print(f"{'Would remove' if dryRun else 'Removing'} corrupt entry {category}/{key}")
+                if not dryRun:
+                    backend.delete(category, key)
+        leftovers = backend.removeLeftovers(category, dryRun)
+        removed[category] = corrupt + leftovers
+        print(f"{category}: {corrupt} corrupt entries, {leftovers} interrupted writes")
+    return removed
+
+def compact(cfg, dryRun=False, backend=None, upgrades=None):
+    #rewrite older formats in the current one, share identical entries and give the space back
+    #upgrades maps a category to the function loadFromCache upgrades its old entries with (e.g. audible to compactResponse)
+    backend = getBackend() if backend is None else backend
+    upgrades = {} if upgrades is None else upgrades
+    compression = cfg.get("Config/cache/compression", "zlib")
+    for category in categories:
+        upgraded = 0
+        for key, size, stored in list(backend.scan(category)):
+            header = backend.read(category, key, 4) or b""
+            if header.startswith(myx_utilities.cacheMagic) and (len(header) == 4) and (header[3] >= myx_utilities.cacheVersion):
+                continue
+            data = backend.read(category, key)
+            if (data is None) or not isValid(data):
+                continue
+            upgraded += 1
+            if not dryRun:
+                content, version, meta = myx_utilities.decodeCacheEntry(data)
+                if category in upgrades:
+                    content = upgrades[category](content)
+                backend.write(category, key, myx_utilities.encodeCache(content, compression, meta), stored)
+
+        saved = backend.dedupe(category, dryRun)
+        print(f"{category}: {'would upgrade' if dryRun else 'upgraded'} {upgraded} entries to format v{myx_utilities.cacheVersion}, {saved / 1048576:.1f}MB in duplicates")
+
+    if not dryRun:
+        backend.vacuum()
+
+def migrate(target, prune=False, dryRun=False, source=None):
+    #copy every valid entry to the target backend, keeping its stored time, entries already there are skipped so it can be resumed
+    source = getBackend() if source is None else source
+    target = getBackend(target)
+    if source.name == target.name:
+        print(f"The cache already uses the {target.name} backend")
+        return 0
+
+    migrated = 0
+    for category in categories:
+        target.prepare(category)
+        copied, skipped, corrupt = 0, 0, 0
+        for key, size, stored in list(source.scan(category)):
+            targetStored = target.getStored(category, key)
+            if (targetStored is not None) and (targetStored >= stored):
+                skipped += 1
+            else:
+                data = source.read(category, key)
+                if (data is None) or not isValid(data):
+                    corrupt += 1
+                    continue
+                copied += 1
+                if not dryRun:
+                    target.write(category, key, data, stored)
+
+            if prune and not dryRun:
+                source.delete(category, key)
+
+        migrated += copied
+        print(f"{category}: {copied} entries migrated to {target.name}, {skipped} already there, {corrupt} corrupt entries left behind")
+
+    if not dryRun:
+        print(f"\nSet cache/backend to {target.name} in your config to use the migrated cache")
+    return migrated
+
+def runMaintenance(cfg, upgrades=None):
+    #booktree.py config.json cache stats|verify|compact|migrate
+    dryRun = bool(cfg.get("Config/flags/dry_run"))
+    action = cfg.get("Config/cache_maintenance/action")
+    start = time.perf_counter()
+
+    if action == "stats":
+        printStats(getStats(cfg))
+    elif action == "verify":
+        removed = verify(dryRun)
+        print(f"\n{'Would remove' if dryRun else 'Removed'} {sum(removed.values())} entries")
+    elif action == "compact":
+        compact(cfg, dryRun, upgrades=upgrades)
+    elif action == "migrate":
+        migrate(cfg.get("Config/cache_maintenance/target"), bool(cfg.get("Config/cache_maintenance/prune")), dryRun)
+
+    print(f"\nCache {action} finished in {time.perf_counter() - start:.1f}s")
@@ -0,0 +1,139 @@
+import os, re
+import json
+import sqlite3
+import threading
+import time
+import myx_utilities
+import myx_audible
+import myx_cache
+import myx_perf
+
+#Module variables
+catalogFile=os.path.join("__cache__", "catalog.db")
+connection=None
+lock=threading.Lock()
+#asins already written (or read) during this run
+seen=set()
+
+#Local mirror of every Audible product booktree has seen, with a full-text index on title/author/series
+#queue workers write it too, so it uses the rollback journal for the same reason as myx_cache.SQLiteBackend
+def getConnection():
+    global connection
+    if connection is None:
+        dbFile = os.path.join(os.getcwd(), catalogFile)
+        os.makedirs(os.path.dirname(dbFile), exist_ok=True)
+        connection = sqlite3.connect(dbFile, timeout=60, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=DELETE")
+        connection.execute("""CREATE TABLE IF NOT EXISTS products (
+                                asin TEXT PRIMARY KEY, title TEXT, authors TEXT, narrators TEXT,
+                                series TEXT, language TEXT, product TEXT, updated REAL)""")
+        connection.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5 (
+                                asin UNINDEXED, title, authors, series, tokenize='unicode61 remove_diacritics 2')""")
+        connection.commit()
+
+        #a new catalog is seeded with every response already in the audible cache
+        if connection.execute("SELECT COUNT(*) FROM products").fetchone()[0] == 0:
+            seedFromCache(connection)
+
+    return connection
+
+def seedFromCache(db):
+    keys = list(myx_cache.getBackend().keys("audible"))
+    if len(keys) == 0:
+        return
+
+    print (f"Building the local Audible catalog from {len(keys)} cached Audible responses, please wait...")
+    count = 0
+    for key in keys:
+        try:
+            response = myx_audible.compactResponse(myx_utilities.loadFromCache(key, "audible"))
+        except Exception:
+            continue
+
+        products = response.get("products", [])
+        if "product" in response:
+            products = [response["product"]]
+
+        for product in products:
+            if "asin" in product:
+                insertProduct(db, product)
+                count += 1
+    db.commit()
+    print (f"Added {count} products to the local Audible catalog")
+
+def insertProduct(db, product):
+    asin = str(product["asin"])
+    title = " ".join([str(product.get("title", "")), str(product.get("subtitle", ""))]).strip()
+    authors = ", ".join([str(a["name"]) for a in product.get("authors", [])])
+    narrators = ", ".join([str(n["name"]) for n in product.get("narrators", [])])
+    series = ", ".join([str(s["title"]) for s in product.get("series", [])])
+    language = str(product.get("language", ""))
+
+    db.execute("INSERT OR REPLACE INTO products VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+               (asin, title, authors, narrators, series, language, json.dumps(product), time.time()))
+    db.execute("DELETE FROM products_fts WHERE asin = ?", (asin,))
+    db.execute("INSERT INTO products_fts (asin, title, authors, series) VALUES (?, ?, ?, ?)",
+               (asin, title, authors, series))
+
+def addProduct(product):
+    #normalize an Audible product into the catalog, replacing any older copy
+    if (product is None) or ("asin" not in product):
+        return
+
+    asin = str(product["asin"])
+    if asin in seen:
+        return
+    seen.add(asin)
+
+    try:
+        with lock:
+            db = getConnection()
+            with db:
+                insertProduct(db, product)
+    except sqlite3.Error as e:
+        print (f"Unable to add {asin} to the local Audible catalog: {e}")
+
+def getProduct(asin):
+    try:
+        with lock:
+            row = getConnection().execute("SELECT product FROM products WHERE asin = ?", (asin,)).fetchone()
+    except sqlite3.Error as e:
+        print (f"Unable to read the local Audible catalog: {e}")
+        return None
+
+    if row is None:
+        return None
+    seen.add(asin)
+    return json.loads(row[0])
+
+@myx_perf.timed("local catalog")
+def searchCatalog(cfg, asin="", keywords="", language="english", limit=25):
+    #returns Audible products from the local catalog, ranked by relevance to the keywords
+    verbose = bool(cfg.get("Config/flags/verbose"))
+
+    if len(asin):
+        product = getProduct(asin)
+        if product is not None:
+            return [product]
+
+    #quote every keyword so FTS5 doesn't treat them as operators
+    terms = [f'"{t}"' for t in re.sub(r"[^\w\s]", " ", keywords).split() if len(t) > 1]
+    if len(terms) == 0:
+        return []
+
+    try:
+        with lock:
+            rows = getConnection().execute("""SELECT p.product FROM products_fts f JOIN products p ON p.asin = f.asin
+                                              WHERE products_fts MATCH ? AND p.language = ?
+                                              ORDER BY bm25(products_fts) LIMIT ?""",
+                                           (" OR ".join(terms), language, limit)).fetchall()
+    except sqlite3.Error as e:
+        print (f"Unable to search the local Audible catalog: {e}")
+        return []
+
+    if verbose:
+        print (f"Found {len(rows)} candidates in the local Audible catalog for {keywords}")
+
+    products = [json.loads(r[0]) for r in rows]
+    seen.update([str(p["asin"]) for p in products])
+    return products
@@ -1,6 +1,8 @@
 
 from dataclasses import dataclass
 from dataclasses import field
+from dataclasses import asdict
+from dataclasses import replace
 import os, sys, subprocess, shlex, re
 from pprint import pprint
 import json
@@ -13,6 +15,11 @@ from pathvalidate import sanitize_filename
 import myx_utilities
 import myx_audible
 import myx_mam
+import myx_library
+import myx_catalog
+import myx_authors
+import myx_perf
+import myx_duration
 
 #Module variables
 authMode="login"
@@ -34,18 +41,31 @@ popular_fiction_genres = ["Fiction","Fantasy","Science Fiction"
 popular_nonfiction_genres = ["Nonfiction","Non-fiction","Autobiography"
                              ,"Biography","Memoir","Biography Memoir"]
 
+def intern(value):
+    #intern repeated names, leaving anything that isn't a str alone
+    if type(value) == str:
+        return sys.intern(value)
+    return value
+
 #Author and Narrator Classes
-@dataclass
+@dataclass(slots=True)
 class Contributor:
     name:str
     #books:list[int]= field(default_factory=list)
 
+    def __post_init__(self):
+        #the same authors and narrators show up on thousands of books and candidates
+        self.name = intern(self.name)
+
 #Series Class
-@dataclass
+@dataclass(slots=True)
 class Series:
     name:str=""
     part:str=""
     separator:str=""
+
+    def __post_init__(self):
+        self.name = intern(self.name)
     
     def getSeriesPart(self):
         if (len(self.part.strip()) > 0):
@@ -54,12 +74,15 @@ class Series:
             return self.name
 
 #Categories Class
-@dataclass
+@dataclass(slots=True)
 class Categories:
     name:str=""
 
+    def __post_init__(self):
+        self.name = intern(self.name)
+
 #Book Class
-@dataclass
+@dataclass(slots=True)
 class Book:
     asin:str=""
     isbn:str=""
@@ -70,7 +93,7 @@ class Book:
     publisher:str=""
     length:int=0
     duration:float=0
-    matchRate=0
+    matchRate:int=0
     language:str="english"
     snatched:bool=False
     description:str=""
@@ -84,6 +107,9 @@ class Book:
     def addFiles(self, file):
         self.files.append(file)
 
+    def hasTags(self):
+        return bool(len(self.title) or len(self.authors) or len(self.asin) or len(self.series))
+
     def getFullTitle(self, field="subtitle"):
         title=""
         if field == "series":
@@ -227,14 +253,31 @@ class Book:
         book=self.getDictionary(book)
         book["title"]=""
         return book
+
+    def toDict(self):
+        #plain dict of every field, e.g. to put a book on the job queue
+        return asdict(self)
+
+    @staticmethod
+    def fromDict(data):
+        if data is None:
+            return None
+        book=Book(**{k: v for k, v in data.items() if k not in ["series", "authors", "narrators", "genres", "tags"]})
+        book.series=[Series(**s) for s in data.get("series", [])]
+        book.authors=[Contributor(**a) for a in data.get("authors", [])]
+        book.narrators=[Contributor(**n) for n in data.get("narrators", [])]
+        book.genres=[Categories(**g) for g in data.get("genres", [])]
+        book.tags=[Categories(**t) for t in data.get("tags", [])]
+        return book
     
+    @myx_perf.timed("opf")
     def createOPF(self, path):
         #creates an OPF file for this book at the specified path
         myx_utilities.createOPF(self, path)
 
           
 #Book File Class
-@dataclass
+@dataclass(slots=True)
 class BookFile:
     file:posixpath
     fullPath:str
@@ -245,6 +288,8 @@ class BookFile:
     audibleMatch:Book=None
     ffprobeBook:Book=None
     audibleMatches:list[Book]= field(default_factory=list)
+    #False when the duration was extrapolated from a sample of MP3 frames
+    durationExact:bool=True
 
     def getExtension(self):
         return os.path.splitext(self.file)[1].replace(".","")
@@ -259,20 +304,36 @@ class BookFile:
     def getFileName(self):
         return os.path.basename(self.file)
 
-    def __probe_file__ (self):
+    def toDict(self):
+        #the file and its id3 metadata, candidates are not kept
+        return {"file": str(self.file), "fullPath": self.fullPath, "sourcePath": self.sourcePath, "mediaPath": self.mediaPath,
+                "isMatched": self.isMatched, "isHardlinked": self.isHardlinked, "durationExact": self.durationExact,
+                "ffprobeBook": self.ffprobeBook.toDict() if self.ffprobeBook is not None else None}
+
+    @staticmethod
+    def fromDict(data):
+        bf=BookFile(data["file"], data["fullPath"], data["sourcePath"], data["mediaPath"], isMatched=data["isMatched"], isHardlinked=data["isHardlinked"], durationExact=data.get("durationExact", True))
+        bf.ffprobeBook=Book.fromDict(data["ffprobeBook"])
+        return bf
+
+    def __probe_file__ (self, duration=True):
         #ffprobe -loglevel error -show_entries format_tags=artist,album,title,series,part,series-part,isbn,asin,audible_asin,composer -of default=noprint_wrappers=1:nokey=0 -print_format compact "$file")
-        cmnd = ['ffprobe','-loglevel','error','-show_entries','format_tags:format=duration', '-of', 'default=noprint_wrappers=1:nokey=0', '-print_format', 'json', self.fullPath]
+        #the duration is only asked for when it can't be read from the file's headers, for a VBR mp3 ffprobe reads the whole file to find it
+        cmnd = ['ffprobe','-loglevel','error','-show_entries','format_tags:format=duration' if duration else 'format_tags', '-of', 'default=noprint_wrappers=1:nokey=0', '-print_format', 'json', self.fullPath]
         p = subprocess.Popen(cmnd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         out, err =  p.communicate()
         #pprint(json.loads(out))
         return json.loads(out)
 
+    @myx_perf.timed("ffprobe")
     def ffprobe(self, parent):
-        #ffprobe the file
+        #ffprobe the file, its duration comes from its own headers when they have it
+        estimate = myx_duration.getDuration(self.fullPath)
         duration=0
         try:
-            r = self.__probe_file__()
-            duration = float(r["format"]["duration"])
+            r = self.__probe_file__(duration=(estimate is None))
+            if estimate is None:
+                duration = float(r["format"]["duration"])
             metadata= r["format"]["tags"]
         except Exception as e:
             metadata=dict()
@@ -301,29 +362,53 @@ class BookFile:
             composer = re.sub(r"\(.+\)", "", metadata["composer"], flags=re.IGNORECASE)
             for narrator in composer.split(","):
                 book.narrators.append(Contributor(narrator))
-        #duration in minutes
-        book.duration = duration
+        #duration in seconds, from the file's own headers when they have it, the same way as probeDuration
+        book.duration = self.setDuration(estimate, duration)
         
         #return a book object created from  ffprobe
         self.ffprobeBook=book
 
         return book
+
+    @myx_perf.timed("duration probe")
+    def probeDuration(self, tags):
+        #the other files of a book only need their duration, their tags are the representative file's
+        duration = myx_duration.getDuration(self.fullPath)
+        seconds = self.setDuration(duration, myx_duration.probeDuration(self.fullPath) if duration is None else 0)
+        self.ffprobeBook = replace(tags, duration=seconds)
+        return self.ffprobeBook
+
+    def setDuration(self, duration, probed):
+        #(seconds, exact) read from the file, or what ffprobe found if the file couldn't be read
+        if duration is None:
+            self.durationExact = True
+            return probed
+        self.durationExact = duration[1]
+        if not self.durationExact:
+            myx_perf.count("duration estimated")
+        return duration[0]
     
     def hardlinkFile(self, source, target):
+        #check the media library index instead of probing the filesystem
+        library = myx_library.getLibrary(self.mediaPath)
 
         #check if the target path exists
-        if (not os.path.exists(target)):
+        if (not library.hasFolder(target)):
             #make dir path
             print (f"\tCreating target directory: {target} ")
             os.makedirs(target, exist_ok=True)
         
         #check if the file already exists in the target directory
         filename=os.path.join(target, os.path.basename(source).split(os.sep)[-1])
-        if (not os.path.exists(filename)):
+        if (not library.hasFile(filename)):
             try:
                 #print (f"Hardlinking {source} to {filename}")
                 os.link(source, filename)
                 self.isHardlinked=True
+                library.addFile(filename)
+            except FileExistsError:
+                print (f"\tSkipped : {filename} exists")
+                library.addFile(filename)
             except Exception as e:
                 print (f"\tFailed due to {e}")
         else:
@@ -349,6 +434,9 @@ class BookFile:
             #standardize author name (replace . with space, and then make sure that there's only single space)
             author=myx_utilities.cleanseAuthor(author)
 
+            #reuse the existing author folder, if this author is already in the library under another spelling
+            author=myx_library.getLibrary(media_path).getAuthorFolder(author)
+
             #Get primary narrator
             if ((book.narrators is not None) and (len(book.authors) == 0)):
                 narrators=""
@@ -415,7 +503,7 @@ class BookFile:
 
         return book
     
-@dataclass
+@dataclass(slots=True)
 class MAMBook:
     name:str
     files:list= field(default_factory=list) 
@@ -431,6 +519,27 @@ class MAMBook:
     metadataBook:Book=None
     paths:str=""
     isMatched:bool=False
+    #candidate counts, kept after the candidates themselves are dropped
+    mamCount:int=0
+    audibleMatchCount:int=0
+
+    def probeFiles(self, cfg):
+        #full tags for one representative file per book, the other files only need their duration for getRunTimeLength
+        #the next file's tags are only read if the representative has none
+        representative = bool(cfg.get("Config/probe/representative", 1))
+        tagged = None
+        for bf in self.files:
+            if (tagged is None) or (not representative):
+                bf.ffprobe(self.name)
+                myx_perf.count("probe tags")
+                if bf.ffprobeBook.hasTags():
+                    tagged = bf
+            else:
+                bf.probeDuration(tagged.ffprobeBook)
+                myx_perf.count("probe duration")
+
+        self.ffprobeBook = (tagged if tagged is not None else self.files[0]).ffprobeBook
+        return self.ffprobeBook
 
     def getRunTimeLength(self):
         #add all the duration of the files in the book, and convert into minutes
@@ -440,6 +549,10 @@ class MAMBook:
 
         return math.floor(duration/60)
 
+    def isRunTimeExact(self):
+        #False if any file's duration is an estimate
+        return all([f.durationExact for f in self.files])
+
     def ffprobe(self, file):
         #ffprobe the file
         metadata=None
@@ -488,15 +601,16 @@ class MAMBook:
 
     def getAudibleBooks(self, client, book, cfg):
         #Config variables
-        minMatchRate = int(cfg.get("Config/matchrate"))
         fixid3 = bool(cfg.get("Config/flags/fixid3"))
         verbose = bool(cfg.get("Config/flags/verbose"))
         add_narrators = bool(cfg.get("Config/flags/add_narrators"))
-        fuzzy_match = cfg.get("Config/fuzzy_match")
+        no_catalog = bool(cfg.get("Config/flags/no_catalog"))
 
         books=[]
         if (book is not None):
             language=book.language
+            #a title made up from the file name, or no author, is too weak to rely on the author/narrator searches
+            weak = (len(book.title) == 0) or fixid3 or (len(book.authors) == 0)
             # book = self.ffprobeBook
             if (len(book.title) == 0) or (fixid3):
                 book.title = myx_utilities.getAltTitle (self.name, book, cfg) 
@@ -521,72 +635,43 @@ class MAMBook:
                                                     myx_utilities.cleanseAuthor(book.getAuthors(delimiter=" "))])
 
             #print(f"Searching Audible for\n\tasin:{book.asin}\n\ttitle:{title}\n\tauthors:{book.authors}\n\tnarrators:{book.narrators}\n\tkeywords:{keywords}")
-            
-            #generate author, narrator combo
-            author_narrator=[]
-            for i in range(len(book.authors)):
-                if add_narrators and len(book.narrators):
-                    for j in range(len(book.narrators)):
-                        author_narrator.append((book.authors[i].name, book.narrators[j].name))
-                else:
-                        author_narrator.append((book.authors[i].name, ""))
-
-            #print (author_narrator)
-
-            for an in author_narrator:
-                #print (f"Author: {an[0]}\tNarrator: {an[1]}")
-                sAuthor=myx_utilities.cleanseAuthor(an[0])
-                sNarrator=myx_utilities.cleanseAuthor(an[1])
-                books=myx_audible.getAudibleBook (client, cfg, asin=book.asin, title=title, authors=sAuthor, narrators=sNarrator, keywords=keywords, language=language)
-
-                #book found, exit for loop
-                if ((books is not None) and len(books)):
-                    break
-                
-            #too constraining?  try just a keywords search with all information
-            if ((books is None) or ((books is not None) and (len(books) == 0))):
-                #print (f"Nothing was found so just doing a keyword search {keywords}")
-                books=myx_audible.getAudibleBook (client, cfg, keywords=keywords, language=language)
 
             mamBook = '|'.join([f"Duration:{self.getRunTimeLength()}min", book.getAuthors(), book.getCleanTitle(), series])
             if add_narrators:
                 mamBook = '|'.join([mamBook, book.getNarrators()])
 
+            #search the local catalog first, only go to Audible if nothing there reaches the matchrate
+            if (not no_catalog):
+                books=myx_catalog.searchCatalog(cfg, asin=book.asin, keywords=keywords, language=language)
+
+                #if the author's catalog was prefetched, all of it is a candidate
+                if len(book.authors):
+                    asins = {str(p.get("asin")) for p in books}
+                    books = books + [p for p in myx_audible.getAuthorBooks(book.authors[0].name, language) if str(p.get("asin")) not in asins]
+
+                if len(books) and (self.findBestAudibleMatch(books, book, title, mamBook, cfg) is not None):
+                    print("Found a match in the local Audible catalog, skipping the Audible search")
+                    self.audibleMatches=books
+                    return self.bestAudibleMatch
+            
+            books=[]
+            combos = myx_audible.planSearches([a.name for a in book.authors], [n.name for n in book.narrators] if add_narrators else [])
+            if myx_audible.isAsinResolved(book.asin):
+                #this ASIN was already looked up in a batch, no need to ask again for every author/narrator
+                books=myx_audible.getResolvedBooks(book.asin, language)
+                combos=[]
+
+            #author/narrator searches, ranked and run a few at a time, then just a keywords search with all information
+            if len(books) == 0:
+                books = myx_audible.searchPlan(client, cfg, combos, asin=book.asin, title=title, keywords=keywords, language=language, speculative=weak)
+
             #process search results
             self.audibleMatches=books
             if (self.audibleMatches is not None):
                 if (verbose):
                     print(f"Found {len(self.audibleMatches)} Audible match(es)\n\n")
 
-                bestMatchRate=0
-                #find the best match
-                print(f"Finding the best Audible match out of {len(books)} results")
-                for product in books:
-                    abook=myx_audible.product2Book(product)
-                    #the author is known, check if this book is this authors book
-                    #otherwise, if maybe this title is close enough
-                    #print (f"{abook.title} by {abook.authors}...")
-                    if len(book.authors) and myx_utilities.isThisMyAuthorsBook(book.authors, abook, cfg):
-                        audibleBook = '|'.join([f"Duration:{abook.length}min", abook.getAuthors(), abook.getCleanTitle(), abook.getSeriesParts()])
-                        if add_narrators:
-                            audibleBook = '|'.join([audibleBook, abook.getNarrators()])
-                    elif myx_utilities.isThisMyBookTitle(title, abook, cfg): 
-                        audibleBook = '|'.join([f"Duration:{abook.length}min", abook.getAuthors(), abook.getCleanTitle(), abook.getSeriesParts()])
-                        if add_narrators:
-                            audibleBook = '|'.join([audibleBook, abook.getNarrators()])
-                    else:
-                        print (f"This book doesn't have a matching title or author, checking the next book...")
-                        continue        
-
-                    #include this book in the comparison
-                    matchRate=myx_utilities.fuzzymatch(mamBook, audibleBook)
-                    abook.matchRate=matchRate[fuzzy_match]
-
-                    print(f"\tMatch Rate: {matchRate}\n\tSearch: {mamBook}\n\tResult: {audibleBook}\n\tBest Match Rate: {bestMatchRate}\n")
-                    
-                    if (matchRate[fuzzy_match] > bestMatchRate) and (matchRate[fuzzy_match] >= minMatchRate):
-                        bestMatchRate=matchRate[fuzzy_match]
-                        self.bestAudibleMatch=abook
+                self.findBestAudibleMatch(books, book, title, mamBook, cfg)
         #end if
 
         #pprint(self.bestAudibleMatch)
@@ -595,7 +680,81 @@ class MAMBook:
             return self.bestAudibleMatch
         else: 
             return None
+
+    def matchAsin(self, client, cfg):
+        #an id3 AUDIBLE_ASIN, or a MAM match with an ASIN, identifies the book: a single ASIN fetch is enough
+        #returns the confidence tier, or None if the ASIN doesn't settle it
+        id3Asin = self.ffprobeBook.asin if self.ffprobeBook is not None else ""
+        mamAsin = self.bestMAMMatch.asin if self.bestMAMMatch is not None else ""
+        asin = id3Asin if len(id3Asin) else mamAsin
+        if len(asin) == 0:
+            return None
+
+        book = self.ffprobeBook if len(id3Asin) else self.bestMAMMatch
+        products = myx_audible.getAudibleProduct(client, cfg, asin, book.language)
+        if len(products) == 0:
+            return None
+        abook = myx_audible.product2Book(products[0])
+
+        #when id3 and MAM agree on the ASIN there's nothing to check, otherwise the author or title has to match too
+        agreed = len(id3Asin) and (id3Asin == mamAsin)
+        if (not agreed) and not (myx_utilities.isThisMyAuthorsBook(book.authors, abook, cfg) or myx_utilities.isThisMyBookTitle(book.title, abook, cfg)):
+            print (f"ASIN {asin} is {abook.title}, which doesn't look like this book")
+            return None
+
+        print (f"Matched ASIN {asin}: {abook.title}")
+        abook.matchRate = 100
+        self.audibleMatches = products
+        self.bestAudibleMatch = abook
+        return "asin agreement" if agreed else "asin"
+
+    def findBestAudibleMatch(self, books, book, title, mamBook, cfg):
+        #Config variables
+        minMatchRate = int(cfg.get("Config/matchrate"))
+        add_narrators = bool(cfg.get("Config/flags/add_narrators"))
+        fuzzy_match = cfg.get("Config/fuzzy_match")
+
+        bestMatch=None
+        bestMatchRate=0
+        #find the best match
+        print(f"Finding the best Audible match out of {len(books)} results")
+        if not self.isRunTimeExact():
+            print(f"The duration of {self.name} is estimated from a sample of its MP3 frames")
+        for product in books:
+            abook=myx_audible.product2Book(product)
+            #the author is known, check if this book is this authors book
+            #otherwise, if maybe this title is close enough
+            #print (f"{abook.title} by {abook.authors}...")
+            if len(book.authors) and myx_utilities.isThisMyAuthorsBook(book.authors, abook, cfg):
+                audibleBook = '|'.join([f"Duration:{abook.length}min", abook.getAuthors(), abook.getCleanTitle(), abook.getSeriesParts()])
+                if add_narrators:
+                    audibleBook = '|'.join([audibleBook, abook.getNarrators()])
+            elif myx_utilities.isThisMyBookTitle(title, abook, cfg): 
+                audibleBook = '|'.join([f"Duration:{abook.length}min", abook.getAuthors(), abook.getCleanTitle(), abook.getSeriesParts()])
+                if add_narrators:
+                    audibleBook = '|'.join([audibleBook, abook.getNarrators()])
+            else:
+                print (f"This book doesn't have a matching title or author, checking the next book...")
+                continue        
+
+            #include this book in the comparison
+            matchRate=myx_utilities.fuzzymatch(mamBook, audibleBook)
+            abook.matchRate=matchRate[fuzzy_match]
+
+            print(f"\tMatch Rate: {matchRate}\n\tSearch: {mamBook}\n\tResult: {audibleBook}\n\tBest Match Rate: {bestMatchRate}\n")
+            
+            if (matchRate[fuzzy_match] > bestMatchRate) and (matchRate[fuzzy_match] >= minMatchRate):
+                bestMatchRate=matchRate[fuzzy_match]
+                self.bestAudibleMatch=abook
+                bestMatch=abook
+
+        #the same ASIN and title is the same book, whatever the authors are called
+        if (bestMatch is not None) and len(book.asin) and (bestMatch.asin == book.asin) and myx_utilities.isThisMyBookTitle(title, bestMatch, cfg):
+            myx_authors.learnAliases(book.authors, bestMatch.authors)
+
+        return bestMatch
         
+    @myx_perf.timed("hardlinking")
     def createHardLinks(self, cfg):
         #Config variables
         dryRun = bool (cfg.get("Config/flags/dry_run"))
@@ -635,6 +794,7 @@ class MAMBook:
                     print (f"\tGenerating OPF file ...")
                     if (not no_opf):
                         self.metadataBook.createOPF(p)
+                        myx_library.getLibrary(f.mediaPath).addAsin(self.metadataBook.asin, p)
 
     def matchFound(self):
         return bool(((self.bestMAMMatch is not None) or (self.bestAudibleMatch is not None)))
@@ -648,8 +808,8 @@ class MAMBook:
         book["mediaPath"]=bf.mediaPath
         book["isMatched"]=self.isMatched
         book["isHardLinked"]= bf.isHardlinked
-        book["mamCount"]=len(self.mamMatches)
-        book["audibleMatchCount"]=len(self.audibleMatches)
+        book["mamCount"]=self.getMAMCount()
+        book["audibleMatchCount"]=self.getAudibleMatchCount()
         book["metadatasource"]=self.metadata
 
         #check out the targetpath of the bookfile
@@ -745,13 +905,53 @@ class MAMBook:
         else: 
             return None
     
+    def getMAMCount(self):
+        return max(self.mamCount, len(self.mamMatches or []))
+
+    def getAudibleMatchCount(self):
+        return max(self.audibleMatchCount, len(self.audibleMatches or []))
+
+    def dropCandidates(self):
+        #once the best matches are chosen, the other candidates are no longer needed
+        self.mamCount = self.getMAMCount()
+        self.audibleMatchCount = self.getAudibleMatchCount()
+        self.mamMatches = []
+        self.audibleMatches = []
+
     def getHashKey(self):
         return myx_utilities.getHash(self.name)
 
+    def toDict(self):
+        #the book, its files and best matches, e.g. to put it on the job queue and back
+        books=["ffprobeBook", "bestAudibleMatch", "bestMAMMatch", "metadataBook"]
+        data={b: getattr(self, b).toDict() if getattr(self, b) is not None else None for b in books}
+        data.update({"name": self.name, "files": [f.toDict() for f in self.files],
+                     "isSingleFile": self.isSingleFile, "isMultiFileBook": self.isMultiFileBook, "isMultiBookCollection": self.isMultiBookCollection,
+                     "metadata": self.metadata, "paths": self.paths, "isMatched": self.isMatched,
+                     "mamCount": self.getMAMCount(), "audibleMatchCount": self.getAudibleMatchCount()})
+        return data
+
+    @staticmethod
+    def fromDict(data):
+        mb=MAMBook(data["name"])
+        mb.files=[BookFile.fromDict(f) for f in data["files"]]
+        for b in ["ffprobeBook", "bestAudibleMatch", "bestMAMMatch", "metadataBook"]:
+            setattr(mb, b, Book.fromDict(data[b]))
+        for k in ["isSingleFile", "isMultiFileBook", "isMultiBookCollection", "metadata", "paths", "isMatched", "mamCount", "audibleMatchCount"]:
+            setattr(mb, k, data[k])
+        return mb
+
+    def getFingerprint(self):
+        #the set of source files this book was built from, no disk access needed
+        return myx_utilities.getHash("|".join(sorted([str(f.file) for f in self.files])))
+
+    @myx_perf.timed("book cache checks")
     def isCached(self, category, cfg):
-        return myx_utilities.isCached(self.getHashKey(),category, cfg)
+        return myx_utilities.isCached(self.getHashKey(),category, cfg, self.getFingerprint())
         
     def cacheMe(self, category, content, cfg):
+        if (category == "book"):
+            myx_utilities.indexBook(self.getHashKey(), self.getFingerprint())
         return myx_utilities.cacheMe(self.getHashKey(),category, content, cfg) 
         
     def loadFromCache(self, category):
@@ -0,0 +1,188 @@
+import os
+import json
+import struct
+import subprocess
+
+#Durations read from the file itself, without starting ffprobe or reading the whole file
+#returns (seconds, exact) or None if the format isn't handled or the file can't be read, exact is False for an estimate
+def getDuration(path):
+    extension = os.path.splitext(path)[1].lower()
+    try:
+        with open(path, mode='rb') as file:
+            if extension in [".m4b", ".m4a", ".mp4"]:
+                return getMP4Duration(file)
+            if extension == ".mp3":
+                return getMP3Duration(file)
+    except (OSError, struct.error, ValueError, IndexError):
+        #a truncated or damaged file, ffprobe gets to try instead
+        return None
+    return None
+
+def getMP4Duration(file):
+    #the duration is in the movie header: moov/mvhd, moov can be before or after the media data
+    size = os.fstat(file.fileno()).st_size
+    moov = findAtom(file, b"moov", 0, size)
+    if moov is None:
+        return None
+    mvhd = findAtom(file, b"mvhd", moov[0], moov[1])
+    if mvhd is None:
+        return None
+
+    file.seek(mvhd[0])
+    header = file.read(32)
+    if len(header) < 4:
+        return None
+    if header[0] == 1:
+        timescale, duration = struct.unpack(">IQ", header[20:32])
+    else:
+        timescale, duration = struct.unpack(">II", header[12:20])
+
+    if timescale == 0:
+        return None
+    return (duration / timescale, True)
+
+def findAtom(file, name, start, end):
+    #(start, end) of the atom's payload, walking the atoms between start and end
+    position = start
+    while position + 8 <= end:
+        file.seek(position)
+        header = file.read(8)
+        if len(header) < 8:
+            return None
+        atomSize, atomType = struct.unpack(">I4s", header)
+        headerSize = 8
+        if atomSize == 1:
+            atomSize = struct.unpack(">Q", file.read(8))[0]
+            headerSize = 16
+        elif atomSize == 0:
+            atomSize = end - position
+
+        if atomSize < headerSize:
+            return None
+        if atomType == name:
+            return (position + headerSize, position + atomSize)
+        position += atomSize
+    return None
+
+#MPEG audio frame header tables, indexed by version (1, 2, 2.5) and layer (1, 2, 3)
+bitrates = {
+    (1, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (1, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+bitrates[(2, 3)] = bitrates[(2, 2)]
+sampleRates = {1: [44100, 48000, 32000], 2: [22050, 24000, 16000], 2.5: [11025, 12000, 8000]}
+
+def parseFrameHeader(header):
+    #(frame length, samples per frame, sample rate, bitrate, version, mono) of a valid MPEG audio frame header, None otherwise
+    if (len(header) < 4) or (header[0] != 0xFF) or ((header[1] & 0xE0) != 0xE0):
+        return None
+    version = {3: 1, 2: 2, 0: 2.5}.get((header[1] >> 3) & 0x03)
+    layer = {3: 1, 2: 2, 1: 3}.get((header[1] >> 1) & 0x03)
+    bitrateIndex = header[2] >> 4
+    rateIndex = (header[2] >> 2) & 0x03
+    if (version is None) or (layer is None) or (bitrateIndex in [0, 15]) or (rateIndex == 3):
+        return None
+
+    bitrate = bitrates[(1 if version == 1 else 2, layer)][bitrateIndex] * 1000
+    sampleRate = sampleRates[version][rateIndex]
+    padding = (header[2] >> 1) & 0x01
+    mono = ((header[3] >> 6) & 0x03) == 3
+
+    if layer == 1:
+        return ((12 * bitrate // sampleRate + padding) * 4, 384, sampleRate, bitrate, version, mono)
+    samples = 576 if (layer == 3) and (version != 1) else 1152
+    return (samples // 8 * bitrate // sampleRate + padding, samples, sampleRate, bitrate, version, mono)
+
+def findFrame(data, start=0):
+    #offset of the first frame header in data that's followed by another valid frame header
+    position = data.find(b"\xFF", start)
+    while (position >= 0) and (position + 4 <= len(data)):
+        frame = parseFrameHeader(data[position:position+4])
+        if frame is not None:
+            following = data[position+frame[0]:position+frame[0]+4]
+            if (len(following) < 4) or (parseFrameHeader(following) is not None):
+                return position
+        position = data.find(b"\xFF", position + 1)
+    return -1
+
+def getMP3Duration(file, sampleFrames=1000, segments=8):
+    #the Xing/Info or VBRI header of the first frame has the frame count: exact, minus the LAME encoder delay and padding
+    #without one, a few frames at evenly spaced points are sampled and their size extrapolated to the whole file: estimated
+    size = os.fstat(file.fileno()).st_size
+
+    #skip the ID3v2 tag, its size is syncsafe
+    head = file.read(10)
+    audioStart = 0
+    if head[:3] == b"ID3":
+        audioStart = 10 + ((head[6] << 21) | (head[7] << 14) | (head[8] << 7) | head[9]) + (10 if head[5] & 0x10 else 0)
+
+    #an ID3v1 tag at the end isn't audio
+    audioEnd = size
+    if size >= 128:
+        file.seek(size - 128)
+        if file.read(3) == b"TAG":
+            audioEnd -= 128
+
+    file.seek(audioStart)
+    data = file.read(65536)
+    position = findFrame(data)
+    if position < 0:
+        return None
+    audioStart += position
+    data = data[position:]
+    frameLength, samples, sampleRate, bitrate, version, mono = parseFrameHeader(data[:4])
+
+    #Xing (VBR) or Info (CBR) header, after the side information
+    xing = 4 + ((17 if mono else 32) if version == 1 else (9 if mono else 17))
+    if data[xing:xing+4] in [b"Xing", b"Info"]:
+        flags = int.from_bytes(data[xing+4:xing+8], "big")
+        if flags & 0x01:
+            frames = int.from_bytes(data[xing+8:xing+12], "big")
+            total = frames * samples
+
+            #the LAME tag follows the Xing fields, with the encoder delay and padding added to the first and last frames
+            lame = xing + 8 + sum([4 for flag in [0x01, 0x02, 0x08] if flags & flag]) + (100 if flags & 0x04 else 0)
+            if data[lame:lame+4] == b"LAME":
+                delay = int.from_bytes(data[lame+21:lame+24], "big")
+                total -= (delay >> 12) + (delay & 0xFFF)
+            return (max(total, 0) / sampleRate, True)
+
+    #VBRI header, 32 bytes after the frame header
+    if data[36:40] == b"VBRI":
+        frames = int.from_bytes(data[50:54], "big")
+        return (frames * samples / sampleRate, True)
+
+    #sample frames at evenly spaced points of the audio, a constant bitrate means every point agrees
+    audioBytes = audioEnd - audioStart
+    sampledBytes, sampledFrames = 0, 0
+    perSegment = max(1, sampleFrames // segments)
+    for segment in range(segments):
+        offset = audioStart + (audioBytes * segment // segments)
+        file.seek(offset)
+        chunk = file.read(perSegment * 1500)
+        position = findFrame(chunk)
+        while (position >= 0) and (sampledFrames < perSegment * (segment + 1)):
+            frame = parseFrameHeader(chunk[position:position+4])
+            if (frame is None) or (position + frame[0] > len(chunk)):
+                break
+            sampledBytes += frame[0]
+            sampledFrames += 1
+            position += frame[0]
+
+    if sampledFrames == 0:
+        return None
+    frames = audioBytes * sampledFrames / sampledBytes
+    return (frames * samples / sampleRate, False)
+
+def probeDuration(path):
+    #ffprobe asked for the duration only, for files whose duration can't be read above
+    cmnd = ['ffprobe', '-loglevel', 'error', '-show_entries', 'format=duration', '-print_format', 'json', path]
+    try:
+        p = subprocess.Popen(cmnd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = p.communicate()
+        return float(json.loads(out)["format"]["duration"])
+    except Exception:
+        return 0
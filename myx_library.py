@@ -0,0 +1,323 @@
+from dataclasses import dataclass
+from dataclasses import field
+import os, re
+import json
+import threading
+import myx_utilities
+import myx_authors
+
+#Module variables, one library index per media_path
+libraries={}
+libraryLock=threading.Lock()
+
+#Media Library Class - what already exists under media_path
+@dataclass
+class MediaLibrary:
+    mediaPath:str
+    #relative dir: {mtime, dirs, files}
+    folders:dict= field(default_factory=dict)
+    #relative file: [dev, inode, size]
+    files:dict= field(default_factory=dict)
+    #asin: relative dir of the book
+    asins:dict= field(default_factory=dict)
+    #author key: author folder name
+    authors:dict= field(default_factory=dict)
+    #(device, inode) of every file, built on demand and not persisted
+    inodes:set= field(default=None, repr=False)
+    #paths sharing this media path change the index from their own threads (--path-workers)
+    lock:threading.RLock= field(default_factory=threading.RLock, repr=False)
+
+    def getIndexFile(self):
+        return os.path.join(os.getcwd(), "__cache__", "library", f"{myx_utilities.getHash(os.path.abspath(self.mediaPath))}.json")
+
+    def load(self):
+        #load a previously built index, returns False if there isn't one
+        indexFile = self.getIndexFile()
+        if not os.path.exists(indexFile):
+            return False
+
+        try:
+            with open(indexFile, mode='r', encoding='utf-8') as file:
+                index = json.loads(file.read())
+            self.folders = index["folders"]
+            self.files = index["files"]
+            self.asins = index["asins"]
+            #author keys are recomputed, aliases may have been learned since the index was saved
+            self.authors = {}
+            for d in index["authors"].values():
+                self.authors.setdefault(myx_authors.getAuthorKey(d), d)
+            return True
+        except Exception as e:
+            print (f"Unable to read the library index {indexFile}, rebuilding it: {e}")
+            self.folders, self.files, self.asins, self.authors = {}, {}, {}, {}
+            return False
+
+    def save(self):
+        #write the index atomically
+        indexFile = self.getIndexFile()
+        os.makedirs(os.path.dirname(indexFile), exist_ok=True)
+        tmpFile = f"{indexFile}.{os.getpid()}.tmp"
+        with self.lock:
+            with open(tmpFile, mode="w", encoding='utf-8') as file:
+                file.write(json.dumps({"mediaPath": self.mediaPath, "folders": self.folders, "files": self.files, "asins": self.asins, "authors": self.authors}))
+            os.replace(tmpFile, indexFile)
+
+    def scan(self):
+        #full scan of the media tree
+        with self.lock:
+            self.folders, self.files, self.asins, self.authors = {}, {}, {}, {}
+            self.__scan_folder__("")
+
+    def refresh(self):
+        with self.lock:
+            return self.__refresh__()
+
+    def __refresh__(self):
+        #incremental refresh: only folders whose mtime changed are re-read
+        changed = 0
+        for relDir in list(self.folders.keys()):
+            if relDir not in self.folders:
+                #removed while purging a parent
+                continue
+            try:
+                mtime = os.stat(os.path.join(self.mediaPath, relDir)).st_mtime
+            except OSError:
+                self.__purge_folder__(relDir)
+                changed += 1
+                continue
+
+            if mtime != self.folders[relDir]["mtime"]:
+                self.__scan_folder__(relDir, recursive=False)
+                changed += 1
+
+        return changed
+
+    def __scan_folder__(self, relDir, recursive=True):
+        fullDir = os.path.join(self.mediaPath, relDir)
+        old = self.folders.get(relDir, {"dirs": [], "files": []})
+
+        try:
+            st = os.stat(fullDir)
+            entries = list(os.scandir(fullDir))
+        except OSError as e:
+            print (f"Unable to scan {fullDir}: {e}")
+            self.__purge_folder__(relDir)
+            return
+
+        dirs=[]
+        files=[]
+        for entry in entries:
+            relPath = os.path.join(relDir, entry.name)
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    #ignore synology metadata folders
+                    if (entry.name != "@eaDir"):
+                        dirs.append(entry.name)
+                elif entry.is_file(follow_symlinks=False):
+                    fst = entry.stat(follow_symlinks=False)
+                    files.append(entry.name)
+                    self.files[relPath] = [fst.st_dev, fst.st_ino, fst.st_size]
+                    if (entry.name == "metadata.opf"):
+                        self.__read_opf__(relDir)
+            except OSError:
+                continue
+
+        #drop whatever disappeared since the last scan
+        for f in old["files"]:
+            if f not in files:
+                self.files.pop(os.path.join(relDir, f), None)
+                if (f == "metadata.opf"):
+                    self.__drop_asins__(relDir)
+        for d in old["dirs"]:
+            if d not in dirs:
+                self.__purge_folder__(os.path.join(relDir, d))
+
+        self.folders[relDir] = {"mtime": st.st_mtime, "dirs": dirs, "files": files}
+
+        #top level folders are author folders
+        if (relDir == ""):
+            self.authors = {}
+            for d in dirs:
+                self.authors.setdefault(myx_authors.getAuthorKey(d), d)
+
+        for d in dirs:
+            child = os.path.join(relDir, d)
+            if recursive or (child not in self.folders):
+                self.__scan_folder__(child)
+
+    def __purge_folder__(self, relDir):
+        folder = self.folders.pop(relDir, None)
+        if folder is None:
+            return
+        for f in folder["files"]:
+            self.files.pop(os.path.join(relDir, f), None)
+        self.__drop_asins__(relDir)
+        for d in folder["dirs"]:
+            self.__purge_folder__(os.path.join(relDir, d))
+
+    def __drop_asins__(self, relDir):
+        for asin in [a for a, d in self.asins.items() if d == relDir]:
+            self.asins.pop(asin)
+
+    def __read_opf__(self, relDir):
+        #parse the ASIN from metadata.opf
+        try:
+            with open(os.path.join(self.mediaPath, relDir, "metadata.opf"), mode='r', encoding='utf-8', errors='ignore') as file:
+                m = re.search(r"<dc:identifier opf:scheme=[\"']ASIN[\"']>\s*([^<\s]+)\s*</dc:identifier>", file.read(), flags=re.IGNORECASE)
+            if m is not None:
+                self.asins[m.group(1)] = relDir
+        except OSError:
+            pass
+
+    def getRelPath(self, path):
+        return os.path.relpath(path, self.mediaPath)
+
+    def hasFolder(self, path):
+        return self.getRelPath(path) in self.folders
+
+    def hasFile(self, path):
+        return self.getRelPath(path) in self.files
+
+    def findAsin(self, asin):
+        #returns the folder of the book with this asin, or None
+        if len(asin) and (asin in self.asins):
+            return os.path.join(self.mediaPath, self.asins[asin])
+        return None
+
+    def isLinked(self, path):
+        #is this (source) file already hardlinked somewhere in the library?
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+
+        #a file with a single link can't be in the library
+        if (st.st_nlink < 2):
+            return False
+
+        with self.lock:
+            if self.inodes is None:
+                self.inodes = {(f[0], f[1]) for f in self.files.values()}
+
+            return (st.st_dev, st.st_ino) in self.inodes
+
+    def consolidateAuthors(self, dryRun=False):
+        #merge top level author folders that are the same author spelled differently, into the one with the most books
+        groups={}
+        for d in self.folders.get("", {}).get("dirs", []):
+            key = myx_authors.getAuthorKey(d)
+            if len(key):
+                groups.setdefault(key, []).append(d)
+
+        prefix = "[Dry Run] : " if dryRun else ""
+        merged = 0
+        for key, dirs in groups.items():
+            if len(dirs) < 2:
+                continue
+            dirs.sort(key=lambda d: -len(self.folders.get(d, {}).get("dirs", [])))
+            for d in dirs[1:]:
+                #a learned alias alone doesn't move folders
+                if not myx_authors.isSameAuthor(d, dirs[0]):
+                    print (f"{d} may be the same author as {dirs[0]}, add it to author_aliases in your config to merge them")
+                    continue
+                print (f"{prefix}Merging author folder {d} into {dirs[0]}")
+                if not dryRun:
+                    self.__merge_folder__(os.path.join(self.mediaPath, d), os.path.join(self.mediaPath, dirs[0]))
+                merged += 1
+
+        #initials vs full names could be different authors, they're only reported
+        expanded={}
+        for key, dirs in groups.items():
+            for e in myx_authors.getAuthorIdentity(dirs[0]).expanded:
+                expanded.setdefault(e, []).append(dirs[0])
+        for key, dirs in groups.items():
+            for a in myx_authors.getAuthorIdentity(dirs[0]).abbreviated:
+                for other in expanded.get(a, []):
+                    print (f"{dirs[0]} may be the same author as {other}, add it to author_aliases in your config to merge them")
+
+        if merged and not dryRun:
+            self.refresh()
+        print (f"{prefix}Merged {merged} author folders in {self.mediaPath}")
+        return merged
+
+    def __merge_folder__(self, source, target):
+        #move everything from source into target, folders that exist in both are merged
+        for entry in os.listdir(source):
+            src = os.path.join(source, entry)
+            dst = os.path.join(target, entry)
+            try:
+                if not os.path.exists(dst):
+                    os.rename(src, dst)
+                elif os.path.isdir(src) and os.path.isdir(dst):
+                    self.__merge_folder__(src, dst)
+                else:
+                    print (f"Not merging {src}, {dst} already exists")
+            except OSError as e:
+                print (f"Unable to merge {src} into {dst}: {e}")
+
+        try:
+            os.rmdir(source)
+        except OSError:
+            #something was left behind
+            pass
+
+    def getAuthorFolder(self, author):
+        #returns the existing folder name for this author, even if it's spelled differently
+        folder = self.authors.get(myx_authors.getAuthorKey(author), author)
+        return folder if myx_authors.isSameAuthor(author, folder) else author
+
+    def addFile(self, path):
+        #a file was just hardlinked into the library
+        relPath = self.getRelPath(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+
+        with self.lock:
+            self.files[relPath] = [st.st_dev, st.st_ino, st.st_size]
+            if self.inodes is not None:
+                self.inodes.add((st.st_dev, st.st_ino))
+            self.__add_folder__(os.path.dirname(relPath), os.path.basename(relPath))
+
+    def addAsin(self, asin, path):
+        #a metadata.opf was just written for this book
+        if len(asin):
+            with self.lock:
+                self.asins[asin] = self.getRelPath(path)
+
+    def __add_folder__(self, relDir, name, isDir=False):
+        if relDir in self.folders:
+            entries = self.folders[relDir]["dirs" if isDir else "files"]
+            if name not in entries:
+                entries.append(name)
+            return
+
+        self.folders[relDir] = {"mtime": 0, "dirs": [name] if isDir else [], "files": [] if isDir else [name]}
+        if (relDir != ""):
+            parent = os.path.dirname(relDir)
+            self.__add_folder__(parent, os.path.basename(relDir), isDir=True)
+            if (parent == ""):
+                self.authors.setdefault(myx_authors.getAuthorKey(relDir), relDir)
+
+def getLibrary(mediaPath, cfg=None):
+    #returns the index for this media path, loading and refreshing it once per run
+    key = os.path.abspath(mediaPath)
+    #paths sharing a media path share one index, built once
+    with libraryLock:
+        if key not in libraries:
+            library = MediaLibrary(mediaPath)
+            if library.load():
+                changed = library.refresh()
+                print (f"Refreshed library index for {mediaPath}: {changed} changed folders, {len(library.files)} files, {len(library.asins)} asins")
+            else:
+                print (f"Building library index for {mediaPath}, please wait...")
+                library.scan()
+                print (f"Indexed {len(library.files)} files, {len(library.authors)} authors, {len(library.asins)} asins")
+            libraries[key] = library
+
+        return libraries[key]
+
+def saveLibraries():
+    for library in libraries.values():
+        library.save()
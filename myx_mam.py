@@ -2,12 +2,19 @@ import requests
 import json
 import os
 import pickle
+import threading
 from pprint import pprint
 import myx_classes
 import myx_utilities
+import myx_perf
 
+#Module variables
+mam_url="https://www.myanonamouse.net"
+#the cookie file is shared by concurrent paths
+cookieLock=threading.Lock()
 
 #MAM Functions
+@myx_perf.timed("mam search")
 def searchMAM(cfg, titleFilename, authors, extension):
     #Config
     session = cfg.get("Config/session")
@@ -27,31 +34,44 @@ def searchMAM(cfg, titleFilename, authors, extension):
     #cache results for this search string
     cacheKey=myx_utilities.getHash(search)
     
-    if myx_utilities.isCached(cacheKey, "mam", cfg):
-        #this search has been done before, load results from cache
-        results = myx_utilities.loadFromCache(cacheKey, "mam")
-        return (results["data"])
-    
-    else:
+    def fetch():
+        if myx_utilities.isCached(cacheKey, "mam", cfg):
+            #this search has been done before, load results from cache
+            return myx_utilities.loadFromCache(cacheKey, "mam", cfg, compactResults)
+
+        if myx_utilities.isOffline(cfg):
+            myx_utilities.offlineMiss("mam")
+            return None
+
+        #every request gets the connect/read deadlines, nothing is left of the book's budget
+        try:
+            timeout = myx_utilities.getTimeout(cfg)
+        except myx_utilities.BudgetExceeded:
+            return None
+
         #save cookie for future use
         cookies_filepath = os.path.join(log_path, 'cookies.pkl')
         sess = requests.Session()
 
         #a cookie file exists, use that
-        if os.path.exists(cookies_filepath):
-            cookies = pickle.load(open(cookies_filepath, 'rb'))
+        with cookieLock:
+            cookies = pickle.load(open(cookies_filepath, 'rb')) if os.path.exists(cookies_filepath) else None
+
+        if cookies is not None:
             sess.cookies = cookies
         else:
             #assume a session ID is passed as a parameter
             sess.headers.update({"cookie": f"mam_id={session}"})
 
         #test session and cookie
-        r = sess.get('https://www.myanonamouse.net/jsonLoad.php', timeout=5)  # test cookie
+        myx_perf.count("network mam")
+        myx_utilities.throttle("mam")
+        r = sess.get(f'{mam_url}/jsonLoad.php', timeout=timeout)  # test cookie
         if r.status_code != 200:
             raise Exception(f'Error communicating with API. status code {r.status_code} {r.text}')
         else:
             # save cookies for later
-            with open(cookies_filepath, 'wb') as f:
+            with cookieLock, open(cookies_filepath, 'wb') as f:
                 pickle.dump(sess.cookies, f)
 
             mam_categories = []
@@ -78,22 +98,36 @@ def searchMAM(cfg, titleFilename, authors, extension):
             }
 
             try:
-                r = sess.post('https://www.myanonamouse.net/tor/js/loadSearchJSONbasic.php', json=params)
+                myx_perf.count("network mam")
+                myx_utilities.throttle("mam")
+                r = sess.post(f'{mam_url}/tor/js/loadSearchJSONbasic.php', json=params, timeout=timeout)
                 if r.text == '{"error":"Nothing returned, out of 0"}':
                     return None
 
-                results = r.json()
+                results = compactResults(r.json())
 
                 #cache this result before returning it
                 myx_utilities.cacheMe(cacheKey, "mam", results, cfg)
 
-                return (results["data"])
+                return results
         
             except Exception as e:
                 print(f'error searching MAM {e}')
 
+        return None
+
+    #identical searches running at the same time share one request
+    results = myx_utilities.singleFlight(cacheKey, "mam", fetch)
+    if results is not None:
+        return (results["data"])
+
     return None
 
+def compactResults(results):
+    #keep only what getMAMBook reads
+    fields = ["asin", "title", "author_info", "series_info", "lang_code", "my_snatched"]
+    return {"data": [{k: b[k] for k in fields if k in b} for b in results.get("data", [])]}
+
 def getMAMBook(cfg, titleFilename="", authors="", extension=""):
     books=[]
     mamBook=searchMAM(cfg, titleFilename, authors, extension)
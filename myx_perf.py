@@ -0,0 +1,222 @@
+import os, sys
+import json
+import cProfile
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+#Module variables, stage timers {stage: {calls, seconds, cpu}} and counters {name: count}
+stages={}
+counters={}
+lock=threading.Lock()
+#profiling, either a cProfile.Profile or a Sampler, optionally limited to some stages
+profiler=None
+profileStages=set()
+profiling=threading.local()
+
+def reset():
+    with lock:
+        stages.clear()
+        counters.clear()
+
+def startStage(name):
+    #wall clock and this thread's cpu time, the difference is time spent waiting (network, disk)
+    profiled = (profiler is not None) and (name in profileStages) and enterProfile()
+    return (name, time.perf_counter(), time.thread_time(), profiled)
+
+def endStage(timer):
+    name, start, cpuStart, profiled = timer
+    elapsed = time.perf_counter() - start
+    cpu = time.thread_time() - cpuStart
+    if profiled:
+        exitProfile()
+
+    with lock:
+        s = stages.setdefault(name, {"calls": 0, "seconds": 0.0, "cpu": 0.0})
+        s["calls"] += 1
+        s["seconds"] += elapsed
+        s["cpu"] += cpu
+    return elapsed
+
+@contextmanager
+def stage(name):
+    timer = startStage(name)
+    try:
+        yield
+    finally:
+        endStage(timer)
+
+def timed(name):
+    #decorator, times every call of a function as a stage
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            timer = startStage(name)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                endStage(timer)
+        return wrapper
+    return decorator
+
+def count(name, n=1):
+    with lock:
+        counters[name] = counters.get(name, 0) + n
+
+def report():
+    with lock:
+        return {"stages": {k: dict(v) for k, v in stages.items()}, "counters": dict(counters)}
+
+def printReport(elapsed=None):
+    r = report()
+    print("\nPerformance report (stage times include the stages they call)")
+    print(f"\t{'stage':>20}  {'wall':>9}  {'share':>6}  {'cpu':>9}  {'waiting':>7}  {'calls':>8}")
+    for name, s in sorted(r["stages"].items(), key=lambda s: -s[1]["seconds"]):
+        share = f"{100 * s['seconds'] / elapsed:5.1f}%" if elapsed else ""
+        waiting = 100 * max(s["seconds"] - s["cpu"], 0) / s["seconds"] if s["seconds"] else 0
+        print(f"\t{name:>20}: {s['seconds']:8.2f}s  {share:>6}  {s['cpu']:8.2f}s  {waiting:6.1f}%  {s['calls']:>8}")
+
+    for name, n in sorted(r["counters"].items()):
+        print(f"\t{name:>20}: {n}")
+
+    if elapsed:
+        print(f"\t{'total':>20}: {elapsed:9.2f}s")
+
+def writeReport(path, elapsed=None, extra=None):
+    r = report()
+    r["elapsed"] = elapsed
+    if extra is not None:
+        r.update(extra)
+    with open(path, mode="w", encoding="utf-8") as file:
+        file.write(json.dumps(r, indent=2))
+    print(f"Performance report saved to {path}")
+
+class Sampler(threading.Thread):
+    #samples the stacks of the other threads every interval, into speedscope's sampled format
+    def __init__(self, interval=0.005, stagesOnly=False):
+        super().__init__(name="booktree-sampler", daemon=True)
+        self.interval = interval
+        self.stagesOnly = stagesOnly
+        #thread id -> depth of profiled stages running on it
+        self.active = {}
+        self.frames = {}
+        self.samples = {}
+        self.stopped = threading.Event()
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    def frameIndex(self, code):
+        key = (code.co_name, code.co_filename, code.co_firstlineno)
+        if key not in self.frames:
+            self.frames[key] = len(self.frames)
+        return self.frames[key]
+
+    def run(self):
+        me = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for tid, frame in sys._current_frames().items():
+                if (tid == me) or (self.stagesOnly and not self.active.get(tid)):
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self.frameIndex(frame.f_code))
+                    frame = frame.f_back
+                stack = tuple(reversed(stack))
+                self.samples[stack] = self.samples.get(stack, 0) + 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.elapsed = time.perf_counter() - self.started
+
+    def save(self, path):
+        frames = [{"name": name, "file": file, "line": line} for (name, file, line) in self.frames]
+        stacks = list(self.samples.items())
+        profile = {"$schema": "https://www.speedscope.app/file-format-schema.json",
+                   "shared": {"frames": frames},
+                   "profiles": [{"type": "sampled", "name": "booktree", "unit": "seconds",
+                                 "startValue": 0, "endValue": self.elapsed,
+                                 "samples": [list(stack) for stack, n in stacks],
+                                 "weights": [n * self.interval for stack, n in stacks]}],
+                   "exporter": "booktree"}
+        with open(path, mode="w", encoding="utf-8") as file:
+            file.write(json.dumps(profile))
+
+def enterProfile():
+    #turns the profiler on for this thread when the first profiled stage starts
+    #stopProfile can clear the profiler from another thread at any time, so it's read once
+    current = profiler
+    if current is None:
+        return False
+
+    depth = getattr(profiling, "depth", 0)
+    profiling.depth = depth + 1
+    if depth:
+        return True
+
+    if isinstance(current, Sampler):
+        current.active[threading.get_ident()] = 1
+    else:
+        try:
+            current.enable()
+        except ValueError:
+            #only one cProfile can be active at a time, another thread already has it
+            profiling.depth = 0
+            return False
+    return True
+
+def exitProfile():
+    profiling.depth -= 1
+    current = profiler
+    if profiling.depth or (current is None):
+        return
+
+    if isinstance(current, Sampler):
+        current.active.pop(threading.get_ident(), None)
+    else:
+        current.disable()
+
+def startProfile(mode="cprofile", stageNames=None, interval=0.005):
+    #profiles the whole run, or only the stages named
+    global profiler
+    profileStages.clear()
+    profileStages.update(stageNames or [])
+
+    if mode == "sample":
+        profiler = Sampler(interval, stagesOnly=bool(profileStages))
+        profiler.start()
+    else:
+        profiler = cProfile.Profile()
+        if len(profileStages) == 0:
+            profiler.enable()
+
+    what = ", ".join(sorted(profileStages)) if len(profileStages) else "the whole run"
+    print(f"Profiling {what} with {'a sampling profiler' if mode == 'sample' else 'cProfile'}")
+
+def stopProfile(basePath, top=20):
+    #saves the profile as basePath.pstats (cProfile) or basePath.speedscope.json (sampling)
+    global profiler
+    if profiler is None:
+        return None
+
+    current = profiler
+    profiler = None
+    profileStages.clear()
+
+    if isinstance(current, Sampler):
+        current.stop()
+        path = f"{basePath}.speedscope.json"
+        current.save(path)
+        print(f"Sampling profile saved to {path}, open it in https://www.speedscope.app")
+        return path
+
+    current.disable()
+    path = f"{basePath}.pstats"
+    current.dump_stats(path)
+    print(f"\nTop {top} functions by cumulative time")
+    stats = pstats.Stats(current)
+    stats.sort_stats("cumulative").print_stats(top)
+    print(f"cProfile stats saved to {path}, e.g. python -m pstats {os.path.basename(path)}")
+    return path
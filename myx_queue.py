@@ -0,0 +1,188 @@
+import os
+import json
+import socket
+import sqlite3
+import time
+import myx_utilities
+import myx_classes
+
+#Module variables
+queueFile=os.path.join("__cache__", "queue.db")
+
+#Durable job queue shared by a coordinator and any number of workers
+#jobs move pending -> leased -> done -> linked, a lease that isn't completed in time goes back to the queue
+#the rollback journal (not WAL) is used, so the queue also works on a mount shared by several hosts
+def getConnection():
+    dbFile = os.path.join(os.getcwd(), queueFile)
+    os.makedirs(os.path.dirname(dbFile), exist_ok=True)
+    db = sqlite3.connect(dbFile, timeout=60, isolation_level=None)
+    db.execute("PRAGMA journal_mode=DELETE")
+    db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                    key TEXT PRIMARY KEY, run TEXT, fingerprint TEXT, state TEXT, book TEXT, result TEXT,
+                    worker TEXT, lease_until REAL, attempts INTEGER DEFAULT 0, error TEXT, updated REAL)""")
+    db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, lease_until)")
+    return db
+
+def getWorkerId():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def getJobKey(sourcePath, mb):
+    return myx_utilities.getHash(f"{os.path.abspath(sourcePath)}|{mb.name}")
+
+def enqueue(books, sourcePath, run):
+    #queue books for the workers, a book already queued with the same files keeps its job (and result)
+    db = getConnection()
+    now = time.time()
+    queued = 0
+    try:
+        db.execute("BEGIN IMMEDIATE")
+        for mb in books:
+            key = getJobKey(sourcePath, mb)
+            fingerprint = mb.getFingerprint()
+            row = db.execute("SELECT fingerprint, state FROM jobs WHERE key = ?", (key,)).fetchone()
+            if (row is not None) and (row[0] == fingerprint) and (row[1] in ["pending", "leased", "done"]):
+                db.execute("UPDATE jobs SET run = ? WHERE key = ?", (run, key))
+                continue
+
+            db.execute("""INSERT OR REPLACE INTO jobs (key, run, fingerprint, state, book, result, worker, lease_until, attempts, error, updated)
+                          VALUES (?, ?, ?, 'pending', ?, NULL, NULL, 0, 0, NULL, ?)""",
+                       (key, run, fingerprint, json.dumps(mb.toDict()), now))
+            queued += 1
+        db.execute("COMMIT")
+    finally:
+        db.close()
+
+    return queued
+
+def reap(db, now, maxAttempts=3):
+    #expired leases (their worker died) go back to the queue, or fail once they're out of attempts
+    db.execute("""UPDATE jobs SET state = 'failed', error = COALESCE(error, 'lease expired too many times'), updated = ?
+                  WHERE state = 'leased' AND lease_until < ? AND attempts >= ?""", (now, now, maxAttempts))
+    cursor = db.execute("""UPDATE jobs SET state = 'pending', worker = NULL, lease_until = 0, error = 'lease expired', updated = ?
+                           WHERE state = 'leased' AND lease_until < ?""", (now, now))
+    return cursor.rowcount
+
+def reapExpired(maxAttempts=3):
+    db = getConnection()
+    try:
+        db.execute("BEGIN IMMEDIATE")
+        reaped = reap(db, time.time(), maxAttempts)
+        db.execute("COMMIT")
+    finally:
+        db.close()
+    return reaped
+
+def claim(worker, count=10, leaseSeconds=600, maxAttempts=3):
+    #lease up to count books, including books whose lease expired (their worker died)
+    db = getConnection()
+    now = time.time()
+    jobs = []
+    try:
+        db.execute("BEGIN IMMEDIATE")
+        reap(db, now, maxAttempts)
+        rows = db.execute("""SELECT key, book FROM jobs
+                             WHERE state = 'pending' AND attempts < ?
+                             ORDER BY rowid LIMIT ?""", (maxAttempts, count)).fetchall()
+        for key, book in rows:
+            db.execute("UPDATE jobs SET state = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1, updated = ? WHERE key = ?",
+                       (worker, now + leaseSeconds, now, key))
+            jobs.append((key, myx_classes.MAMBook.fromDict(json.loads(book))))
+        db.execute("COMMIT")
+    finally:
+        db.close()
+
+    return jobs
+
+def renew(keys, worker, leaseSeconds=600):
+    #extend the leases this worker still holds, returns how many it still holds
+    db = getConnection()
+    now = time.time()
+    try:
+        db.execute("BEGIN IMMEDIATE")
+        held = 0
+        for key in keys:
+            cursor = db.execute("UPDATE jobs SET lease_until = ?, updated = ? WHERE key = ? AND state = 'leased' AND worker = ?",
+                                (now + leaseSeconds, now, key, worker))
+            held += cursor.rowcount
+        db.execute("COMMIT")
+    finally:
+        db.close()
+    return held
+
+def complete(key, worker, mb):
+    #only the worker holding the lease can complete a job, a late result from an expired lease is dropped
+    db = getConnection()
+    try:
+        cursor = db.execute("""UPDATE jobs SET state = 'done', result = ?, lease_until = 0, error = NULL, updated = ?
+                               WHERE key = ? AND state = 'leased' AND worker = ?""",
+                            (json.dumps(mb.toDict()), time.time(), key, worker))
+        return cursor.rowcount == 1
+    finally:
+        db.close()
+
+def release(key, worker, error, maxAttempts=3):
+    #give the job back, it's retried until it runs out of attempts
+    db = getConnection()
+    try:
+        db.execute("""UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, lease_until = 0, error = ?, updated = ?
+                      WHERE key = ? AND state = 'leased' AND worker = ?""",
+                   (maxAttempts, str(error), time.time(), key, worker))
+    finally:
+        db.close()
+
+def getStatus(run=None):
+    #{state: count}, for one run or the whole queue
+    db = getConnection()
+    try:
+        if run is None:
+            rows = db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+        else:
+            rows = db.execute("SELECT state, COUNT(*) FROM jobs WHERE run = ? GROUP BY state", (run,)).fetchall()
+    finally:
+        db.close()
+    return dict(rows)
+
+def getResults(run):
+    #the matched books of a run, failed books come back as they were queued
+    db = getConnection()
+    try:
+        rows = db.execute("SELECT key, state, book, result FROM jobs WHERE run = ? AND state IN ('done', 'failed') ORDER BY rowid", (run,)).fetchall()
+    finally:
+        db.close()
+    return [(key, myx_classes.MAMBook.fromDict(json.loads(result if state == "done" else book))) for key, state, book, result in rows]
+
+def markLinked(keys):
+    #the coordinator has created the hardlinks and logged these books
+    db = getConnection()
+    try:
+        db.execute("BEGIN IMMEDIATE")
+        db.executemany("UPDATE jobs SET state = 'linked', updated = ? WHERE key = ? AND state = 'done'", [(time.time(), k) for k in keys])
+        db.execute("COMMIT")
+    finally:
+        db.close()
+
+def coordinate(books, sourcePath, cfg):
+    #queue the probed books, wait for the workers and return the matched books
+    pollSeconds = float(cfg.get("Config/queue/poll_seconds", 5))
+    maxAttempts = int(cfg.get("Config/queue/max_attempts", 3))
+    run = myx_utilities.getHash(f"{getWorkerId()}:{os.path.abspath(sourcePath)}:{time.time()}")
+
+    queued = enqueue(books, sourcePath, run)
+    print (f"Queued {queued} of {len(books)} books for the workers, run booktree with --worker to process them")
+
+    last = None
+    while True:
+        #workers that died leave their leases behind, and the other workers may have exited already
+        reaped = reapExpired(maxAttempts)
+        if reaped:
+            print (f"Returned {reaped} books with an expired lease to the queue")
+        status = getStatus(run)
+        remaining = status.get("pending", 0) + status.get("leased", 0)
+        if status != last:
+            print (f"Queue: {status.get('pending', 0)} pending, {status.get('leased', 0)} in progress, {status.get('done', 0)} done, {status.get('failed', 0)} failed")
+            last = status
+        if remaining == 0:
+            break
+        time.sleep(pollSeconds)
+
+    return getResults(run)
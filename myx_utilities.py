@@ -8,8 +8,271 @@ import mimetypes
 import csv
 import json
 import hashlib
+import threading
+import time
+import zlib
+import httpx
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from langcodes import *
 import myx_classes
+import myx_perf
+import myx_authors
+import myx_cache
+
+#Optional fast codecs and compression for cache payloads
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+#Cache payload format: magic, format version, codec, compression, metadata length and metadata (version 2), payload. Entries without the magic are version 0 (plain JSON)
+#the metadata holds the validators (ETag, Last-Modified) and the URL used to revalidate a stale entry, the entry's age is its file's modification time
+cacheMagic=b"BTC"
+cacheVersion=2
+
+#Processed-book index {hashKey: source fingerprint}, loaded once per run
+bookIndex={}
+bookIndexLoaded=False
+
+#In-flight lookups {category/key: {done, result, error}}, shared by identical concurrent lookups
+inFlight={}
+inFlightLock=threading.Lock()
+
+#Rate limiters {service: RateLimiter}, shared by every path being processed
+rateLimiters={}
+
+#Paths processed concurrently share the logfile
+logLock=threading.Lock()
+
+#The deadline of the book being processed on this thread, and the time each book has already spent {id(book): seconds}
+budget=threading.local()
+budgetSpent={}
+
+#Recent request latencies {service: deque of seconds}, the hedge delay is their percentile
+latencies={}
+latencyLock=threading.Lock()
+hedgePool=None
+
+class RateLimiter:
+    #spaces requests to a service at most rate per second, across all threads
+    def __init__(self, rate):
+        self.interval = (1 / rate) if rate > 0 else 0
+        self.next = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next)
+            self.next = start + self.interval
+
+        if start > now:
+            time.sleep(start - now)
+
+    def tryWait(self):
+        #take a slot only if one is free now, False while requests are queued for the service
+        if not self.interval:
+            return True
+
+        with self.lock:
+            now = time.monotonic()
+            if self.next > now:
+                return False
+            self.next = now + self.interval
+        return True
+
+def setRateLimits(cfg):
+    #requests per second for each service, 0 or missing means no limit
+    rateLimiters.clear()
+    for service, rate in (cfg.get("Config/rate_limit", {}) or {}).items():
+        if float(rate) > 0:
+            rateLimiters[service] = RateLimiter(float(rate))
+
+def throttle(service):
+    if service in rateLimiters:
+        rateLimiters[service].wait()
+
+def tryThrottle(service):
+    return (service not in rateLimiters) or rateLimiters[service].tryWait()
+
+class PrefixedOutput:
+    #stdout for concurrent paths, every line is prefixed with the label of the path that printed it
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def setLabel(self, label):
+        self.local.label = label
+        self.local.buffer = ""
+
+    def getLabel(self):
+        return getattr(self.local, "label", "")
+
+    def write(self, text):
+        label = getattr(self.local, "label", "")
+        if not len(label):
+            with self.lock:
+                return self.stream.write(text)
+
+        #only whole lines are written, so lines from different paths don't interleave
+        self.local.buffer += text
+        lines = re.split(r"(?<=[\n\r])", self.local.buffer)
+        self.local.buffer = lines.pop()
+        if len(lines):
+            with self.lock:
+                self.stream.write("".join([f"[{label}] {line}" for line in lines]))
+        return len(text)
+
+    def flush(self):
+        label = getattr(self.local, "label", "")
+        if len(label) and len(self.local.buffer):
+            with self.lock:
+                self.stream.write(f"[{label}] {self.local.buffer}")
+            self.local.buffer = ""
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+def withThreadContext(fn):
+    #fn runs on another thread, its output keeps the label of the path that started it and its requests the book's deadline
+    output = sys.stdout
+    label = output.getLabel() if isinstance(output, PrefixedOutput) else None
+    deadline, name = getattr(budget, "deadline", None), getattr(budget, "name", "")
+
+    def inherited(*args, **kwargs):
+        if label is not None:
+            output.setLabel(label)
+        budget.deadline, budget.name, budget.exceeded = deadline, name, False
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            budget.deadline = None
+            if label is not None:
+                output.flush()
+    return inherited
+
+class BudgetExceeded(Exception):
+    pass
+
+@contextmanager
+def bookBudget(cfg, mb, last=False):
+    #every request made while processing this book shares Config/timeouts/book_seconds, across the MAM and Audible/Goodreads stages
+    seconds = float(cfg.get("Config/timeouts/book_seconds", 0) or 0)
+    if seconds <= 0:
+        yield
+        return
+
+    start = time.monotonic()
+    budget.deadline = start + seconds - budgetSpent.get(id(mb), 0)
+    budget.name, budget.exceeded = mb.name, False
+    try:
+        yield
+    finally:
+        budget.deadline = None
+        if last:
+            budgetSpent.pop(id(mb), None)
+        else:
+            budgetSpent[id(mb)] = budgetSpent.get(id(mb), 0) + time.monotonic() - start
+
+def getTimeout(cfg):
+    #(connect, read) seconds for one request, cut short by what's left of the book's budget
+    timeouts = (cfg.get("Config/timeouts", {}) if cfg is not None else {}) or {}
+    connect, read = float(timeouts.get("connect", 5)), float(timeouts.get("read", 30))
+
+    deadline = getattr(budget, "deadline", None)
+    if deadline is not None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            if not budget.exceeded:
+                budget.exceeded = True
+                myx_perf.count("books over budget")
+                print (f"{budget.name} ran out of its time budget, skipping its remaining lookups")
+            raise BudgetExceeded(f"{budget.name} ran out of its time budget")
+        connect, read = min(connect, remaining), min(read, remaining)
+
+    return (connect, read)
+
+def getHedgeDelay(cfg, service):
+    #hedging is on for the services listed in Config/hedge/services, once there are enough latencies to know what slow is
+    hedge = (cfg.get("Config/hedge", {}) if cfg is not None else {}) or {}
+    if service not in (hedge.get("services", []) or []):
+        return None
+
+    with latencyLock:
+        samples = sorted(latencies.get(service, []))
+    if len(samples) < int(hedge.get("min_samples", 20)):
+        return None
+
+    delay = samples[min(len(samples) - 1, int(len(samples) * float(hedge.get("percentile", 95)) / 100))]
+    return max(delay, float(hedge.get("min_ms", 250)) / 1000)
+
+def timedGet(client, service, url, kwargs):
+    #the caller has throttled the request, so its latency (and the hedge delay) doesn't include time queued in the rate limiter
+    myx_perf.count(f"network {service}")
+    start = time.monotonic()
+    r = client.get(url, **kwargs)
+    with latencyLock:
+        latencies.setdefault(service, deque(maxlen=200)).append(time.monotonic() - start)
+    return r
+
+def httpGet(client, cfg, service, url, **kwargs):
+    #a throttled GET with connect/read deadlines
+    #a hedged service gets a duplicate request when the first one is slower than the recent percentile, the first response wins
+    #the duplicate takes a rate limiter slot too, and isn't sent while other requests are queued for the service
+    global hedgePool
+    connect, read = getTimeout(cfg)
+    kwargs["timeout"] = httpx.Timeout(read, connect=connect)
+
+    throttle(service)
+    delay = getHedgeDelay(cfg, service)
+    if delay is None:
+        return timedGet(client, service, url, kwargs)
+
+    with latencyLock:
+        if hedgePool is None:
+            hedgePool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="booktree-hedge")
+    first = hedgePool.submit(timedGet, client, service, url, kwargs)
+    done, _ = wait([first], timeout=delay)
+    if len(done):
+        return first.result()
+
+    if not tryThrottle(service):
+        myx_perf.count(f"hedges skipped, {service} rate limited")
+        return first.result()
+
+    myx_perf.count(f"hedged {service} requests")
+    second = hedgePool.submit(timedGet, client, service, url, kwargs)
+    pending = {first, second}
+    error = None
+    while len(pending):
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                r = future.result()
+            except Exception as e:
+                error = e
+                continue
+            if future is second:
+                myx_perf.count(f"hedged {service} wins")
+            return r
+    raise error
 
 ##ffprobe
 def probe_file(filename):
@@ -79,6 +342,7 @@ def standardizeAuthors(mediaPath, dryRun=False):
                     except Exception as e:
                         print (f"Can't rename {f}: {e}")
 
+@myx_perf.timed("fuzzy scoring")
 def fuzzymatch(x:str, y:str):
     newX = x
     newY = y
@@ -190,26 +454,54 @@ def logBookRecords(logFilePath, bookFiles, cfg):
         except csv.Error as e:
             print(f"file {logFilePath}: {e}")
 
+@myx_perf.timed("logging")
 def logBooks(logFilePath, books, cfg):
     if len(books):
-        write_headers = not os.path.exists(logFilePath)
-        with open(logFilePath, mode="a", newline="", errors='ignore') as csv_file:
+        #paths processed concurrently append to the same log
+        with logLock:
+            write_headers = not os.path.exists(logFilePath)
+            with open(logFilePath, mode="a", newline="", errors='ignore') as csv_file:
+                try:
+                    fields=getLogHeaders()
+                    #pprint (fields)
+                    for book in books:
+                        for file in book.files:
+                            row=book.getLogRecord(file,cfg)
+                            #pprint(row)
+                            #create a writer
+                            writer = csv.DictWriter(csv_file, fieldnames=fields)
+                            if write_headers:
+                                writer.writeheader()
+                                write_headers=False
+                            writer.writerow(row)
+
+                except csv.Error as e:
+                    print(f"file {logFilePath}: {e}")
+
+def mergeLogs(logFiles, mergedFile):
+    #combine the logs of a sharded run into one, with a single header
+    files=[]
+    for f in logFiles:
+        files.extend(sorted(glob(f)) if any(c in f for c in "*?[") else [f])
+
+    rows=0
+    fields=getLogHeaders()
+    with open(mergedFile, mode="w", newline="", errors='ignore') as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=fields)
+        writer.writeheader()
+        for logFile in files:
+            if os.path.abspath(logFile) == os.path.abspath(mergedFile):
+                continue
             try:
-                fields=getLogHeaders()
-                #pprint (fields)
-                for book in books:
-                    for file in book.files:
-                        row=book.getLogRecord(file,cfg)
-                        #pprint(row)
-                        #create a writer
-                        writer = csv.DictWriter(csv_file, fieldnames=fields)
-                        if write_headers:
-                            writer.writeheader()
-                            write_headers=False
-                        writer.writerow(row)
+                with open(logFile, newline="", errors='ignore') as log:
+                    for row in csv.DictReader(log):
+                        writer.writerow({k: row.get(k, "") for k in fields})
+                        rows += 1
+            except (OSError, csv.Error) as e:
+                print(f"file {logFile}: {e}")
 
-            except csv.Error as e:
-                print(f"file {logFilePath}: {e}")
+    print(f"Merged {rows} rows from {len(files)} logs into {mergedFile}")
+    return rows
 
 def isCollection (bookFile, source_path):
     #we assume that most books are formatted this way /Book/Files.m4b
@@ -251,7 +543,7 @@ def getLogHeaders():
     headers=['book', 'file', 'paths', 'isMatched', 'isHardLinked', 'mamCount', 'audibleMatchCount', 'metadatasource'
              , 'id3-matchRate', 'id3-asin', 'id3-title', 'id3-subtitle', 'id3-publicationName', 'id3-length', 'id3-duration', 'id3-series', 'id3-authors', 'id3-narrators', 'id3-seriesparts', 'id3-language', 'id3-isbn', 'id3-tags', 'id3-genres'
              , 'mam-matchRate', 'mam-asin', 'mam-title', 'mam-subtitle', 'mam-publicationName', 'mam-length', 'mam-duration', 'mam-series', 'mam-authors', 'mam-narrators', 'mam-seriesparts', 'mam-language', 'mam-isbn', 'mam-tags', 'mam-genres'
-             , 'adb-matchRate', 'adb-asin', 'adb-title', 'adb-subtitle', 'adb-publicationName', 'adb-length', 'adb-duration', 'adb-series', 'adb-authors', 'adb-narrators', 'adb-seriesparts', 'adb-language'
+             , 'adb-matchRate', 'adb-asin', 'adb-title', 'adb-subtitle', 'adb-publicationName', 'adb-length', 'adb-duration', 'adb-series', 'adb-authors', 'adb-narrators', 'adb-seriesparts', 'adb-language', 'adb-isbn', 'adb-tags', 'adb-genres'
              , 'sourcePath', 'mediaPath']
                     
     return dict.fromkeys(headers)
@@ -329,39 +621,291 @@ def createOPF(book, path):
 def getHash(key):
     return hashlib.sha256(key.encode(encoding="utf-8")).hexdigest()
 
-def isCached(key, category, cfg):
+def inShard(key, cfg):
+    #books are partitioned by their grouping key, so every process agrees on the split
+    count = int(cfg.get("Config/shard/count", 1))
+    if count <= 1:
+        return True
+    index = int(cfg.get("Config/shard/index", 1))
+    return (int(getHash(str(key))[:16], 16) % count) == (index - 1)
+
+def isCached(key, category, cfg, fingerprint=""):
     #Config
     verbose = bool(cfg.get("Config/flags/verbose"))
 
     if verbose:
         print (f"Checking cache: {category}/{key}...")
-    
-    #Check if this book's hashkey exists in the cache, if so - it's been processed
-    bookFile = os.path.join(os.getcwd(), "__cache__", category, key)
-    found = os.path.exists(bookFile)  
+
+    #processed books are checked against the in-memory index, not the filesystem
+    if (category == "book"):
+        found = isBookIndexed(key, fingerprint)
+    else:
+        #Check if this book's hashkey exists in the cache, if so - it's been processed
+        stored = myx_cache.getBackend().getStored(category, key)
+        found = (stored is not None)
+
+        #an entry older than its category's TTL has to be revalidated, unless there's no network to do it
+        if found and isStale(stored, category, cfg) and not isOffline(cfg):
+            myx_perf.count(f"cache {category} stale")
+            return False
+
+    myx_perf.count(f"cache {category} {'hit' if found else 'miss'}")
     return found      
+
+def isStale(stored, category, cfg):
+    #Config/cache/ttl is in days per category, 0 or missing never expires
+    ttl = float((cfg.get("Config/cache/ttl", {}) or {}).get(category, 0) or 0)
+    return (ttl > 0) and ((time.time() - stored) > (ttl * 86400))
+
+def readCacheMeta(key, category):
+    #the metadata of a cache entry, without decompressing its payload, empty if there's no entry
+    backend = myx_cache.getBackend()
+    header = backend.read(category, key, 10)
+    if (header is None) or (len(header) < 10) or (not header.startswith(cacheMagic)) or (header[3] < 2):
+        return {}
+    size = int.from_bytes(header[6:10], "big")
+    return json.loads((backend.read(category, key, 10 + size) or header)[10:].decode("utf-8"))
+
+def revalidatingGet(client, cfg, service, key, category, url, **kwargs):
+    #a GET for a cache entry, a stale entry sends its validators and a 304 only extends its lifetime
+    #returns None when the cached content is still current, otherwise the response
+    meta = readCacheMeta(key, category)
+    headers = dict(kwargs.pop("headers", {}) or {})
+    if "etag" in meta:
+        headers["If-None-Match"] = meta["etag"]
+    if "last_modified" in meta:
+        headers["If-Modified-Since"] = meta["last_modified"]
+
+    r = httpGet(client, cfg, service, url, headers=headers, **kwargs)
+    if (r.status_code == 304) and len(meta):
+        myx_cache.getBackend().touch(category, key)
+        myx_perf.count(f"cache {category} revalidated")
+        return None
+    return r
     
-def cacheMe(key, category, content, cfg):
+def isOffline(cfg):
+    #offline runs answer every lookup from the cache, a cache miss is treated as no result
+    return (cfg is not None) and bool(cfg.get("Config/flags/offline"))
+
+def offlineMiss(category):
+    myx_perf.count(f"offline {category} miss")
+
+def getOfflineMisses():
+    #{category: misses} for this run
+    counters = myx_perf.report()["counters"]
+    return {k.split(" ")[1]: v for k, v in counters.items() if k.startswith("offline ") and k.endswith(" miss")}
+
+def cacheMe(key, category, content, cfg, response=None, url="", meta=None):
     #Config
     verbose = bool(cfg.get("Config/flags/verbose"))
+    compression = cfg.get("Config/cache/compression", "zlib")
+
+    #keep the validators of the response this content came from, to revalidate it once it's stale
+    meta = dict(meta or {})
+    if response is not None:
+        if response.headers.get("etag"):
+            meta["etag"] = response.headers["etag"]
+        if response.headers.get("last-modified"):
+            meta["last_modified"] = response.headers["last-modified"]
+    if len(url):
+        meta["url"] = url
+
+    #the backend makes sure an interrupted write doesn't leave a truncated entry
+    myx_cache.getBackend().write(category, key, encodeCache(content, compression, meta))
+
+    if verbose:
+        print(f"Caching {category}/{key}")
+    return True
+
+def encodeCache(content, compression="zlib", meta=None):
+    #serialize with the fastest codec available
+    if orjson is not None:
+        codec = b"o"
+        payload = orjson.dumps(content)
+    elif msgpack is not None:
+        codec = b"m"
+        payload = msgpack.packb(content, use_bin_type=True)
+    else:
+        codec = b"j"
+        payload = json.dumps(content, separators=(",", ":")).encode("utf-8")
+
+    #zstd falls back to zlib if zstandard isn't installed
+    if (compression == "zstd") and (zstandard is not None):
+        method = b"s"
+        payload = zstandard.ZstdCompressor().compress(payload)
+    elif (compression in ["zstd", "zlib"]):
+        method = b"z"
+        payload = zlib.compress(payload)
+    else:
+        method = b"n"
+
+    metadata = json.dumps(meta or {}, separators=(",", ":")).encode("utf-8")
+    return cacheMagic + bytes([cacheVersion]) + codec + method + len(metadata).to_bytes(4, "big") + metadata + payload
+
+def decodeCache(data):
+    #returns the content and the format version it was written with
+    content, version, meta = decodeCacheEntry(data)
+    return content, version
+
+def decodeCacheEntry(data):
+    #returns the content, the format version it was written with and its metadata
+    if not data.startswith(cacheMagic):
+        return json.loads(data.decode("utf-8")), 0, {}
+
+    version = data[3]
+    codec = data[4:5]
+    method = data[5:6]
+    payload = data[6:]
+    meta = {}
+    if version >= 2:
+        size = int.from_bytes(data[6:10], "big")
+        meta = json.loads(data[10:10+size].decode("utf-8"))
+        payload = data[10+size:]
+
+    if (method == b"s"):
+        if zstandard is None:
+            raise Exception("this cache entry is zstd compressed, please install zstandard")
+        payload = zstandard.ZstdDecompressor().decompress(payload)
+    elif (method == b"z"):
+        payload = zlib.decompress(payload)
+
+    if (codec == b"o") and (orjson is not None):
+        return orjson.loads(payload), version, meta
+    elif (codec == b"m"):
+        if msgpack is None:
+            raise Exception("this cache entry is msgpack encoded, please install msgpack")
+        return msgpack.unpackb(payload, raw=False), version, meta
+    else:
+        #orjson output is plain JSON
+        return json.loads(payload.decode("utf-8")), version, meta
+
+def getBookIndexFile():
+    return os.path.join(os.getcwd(), "__cache__", "book.idx")
+
+def loadBookIndex(cfg):
+    #load the processed-book index in one read, so skip checks don't hit the disk per book
+    global bookIndexLoaded
+    verbose = bool(cfg.get("Config/flags/verbose"))
+
+    bookIndex.clear()
+    indexFile = getBookIndexFile()
+    if os.path.exists(indexFile):
+        try:
+            with open(indexFile, mode='r', encoding='utf-8') as file:
+                bookIndex.update(json.loads(file.read()))
+        except Exception as e:
+            print (f"Unable to read the book index {indexFile}, rebuilding it: {e}")
+
+    #books cached by older versions (or by a run that didn't finish) only exist as cache entries
+    for key in myx_cache.getBackend().keys("book"):
+        bookIndex.setdefault(key, "")
+
+    bookIndexLoaded = True
+    if verbose:
+        print (f"Loaded {len(bookIndex)} processed books from the book index")
+    return len(bookIndex)
+
+def isBookIndexed(key, fingerprint=""):
+    if not bookIndexLoaded:
+        loadBookIndex({})
+
+    if key not in bookIndex:
+        return False
+
+    #a book processed with a different set of source files needs to be processed again
+    processedWith = bookIndex[key]
+    return (len(processedWith) == 0) or (len(fingerprint) == 0) or (processedWith == fingerprint)
+
+def indexBook(key, fingerprint=""):
+    bookIndex[key] = fingerprint
+
+def saveBookIndex(cfg):
+    #write the book index atomically, merging entries written by other booktree processes
+    verbose = bool(cfg.get("Config/flags/verbose"))
+
+    if not bookIndexLoaded:
+        return False
 
-    #create the cache file
-    bookFile = os.path.join(os.getcwd(), "__cache__", category, key)
-    with open(bookFile, mode="w", encoding='utf-8', errors='ignore') as file:
-        file.write(json.dumps(content))
+    indexFile = getBookIndexFile()
+    index = {}
+    if os.path.exists(indexFile):
+        try:
+            with open(indexFile, mode='r', encoding='utf-8') as file:
+                index = json.loads(file.read())
+        except Exception as e:
+            print (f"Unable to read the book index {indexFile}, replacing it with this run's books: {e}")
+            index = {}
+    index.update(bookIndex)
+
+    tmpFile = f"{indexFile}.{os.getpid()}.tmp"
+    with open(tmpFile, mode="w", encoding='utf-8') as file:
+        file.write(json.dumps(index))
+    os.replace(tmpFile, indexFile)
 
     if verbose:
-        print(f"Caching {key} in File: {bookFile}")
-    return os.path.exists(bookFile)        
-
-def loadFromCache(key, category):
-    #return the content from the cache file
-    bookFile = os.path.join(os.getcwd(), "__cache__", category, key)
-    with open(bookFile, mode='r', encoding='utf-8') as file:
-        f = file.read()
+        print (f"Saved {len(index)} processed books to the book index {indexFile}")
+    return True
+
+def singleFlight(key, category, fetch):
+    #the first caller for a cache key runs fetch, concurrent callers for the same key wait for its result
+    #fetch should check the cache itself, so a caller arriving after the first one finished reads the cache
+    flightKey = f"{category}/{key}"
+    with inFlightLock:
+        flight = inFlight.get(flightKey)
+        isLeader = (flight is None)
+        if isLeader:
+            flight = {"done": threading.Event(), "result": None, "error": None}
+            inFlight[flightKey] = flight
+
+    if not isLeader:
+        flight["done"].wait()
+        if flight["error"] is not None:
+            raise flight["error"]
+        return flight["result"]
+
+    try:
+        flight["result"] = fetch()
+    except Exception as e:
+        flight["error"] = e
+        raise
+    finally:
+        with inFlightLock:
+            inFlight.pop(flightKey, None)
+        flight["done"].set()
+
+    return flight["result"]
+
+def loadFromCache(key, category, cfg=None, upgrade=None):
+    #return the content from the cache
+    backend = myx_cache.getBackend()
+    f = backend.read(category, key)
+    if f is None:
+        raise FileNotFoundError(f"{category}/{key} is not in the cache")
+
+    content, version, meta = decodeCacheEntry(f)
+
+    #entries written by older versions are upgraded (e.g. compacted) and rewritten in the current format, as old as they were
+    if (version < cacheVersion):
+        if upgrade is not None:
+            content = upgrade(content)
+        if cfg is not None:
+            stored = backend.getStored(category, key)
+            cacheMe(key, category, content, cfg, meta=meta)
+            backend.touch(category, key, stored)
     
-    return json.loads(f)
+    return content
     
+def loadStale(key, category, cfg, upgrade=None):
+    #a revalidation or refetch that failed serves the stale entry, if there is one, rather than nothing
+    if (cfg is None) or (myx_cache.getBackend().getStored(category, key) is None):
+        return None
+    try:
+        content = loadFromCache(key, category, cfg, upgrade)
+    except Exception:
+        return None
+    myx_perf.count(f"cache {category} served stale")
+    return content
+
 def isMultiCD(parent):
     return re.search(r"disc\s?\d+", parent.lower()) or re.search(r"cd\s?\d+", parent.lower())
 
@@ -374,27 +918,11 @@ def isThisMyAuthorsBook (authors, book, cfg):
     #Config
     verbose = bool(cfg.get("Config/flags/verbose"))
 
-    found=False
-    for author in authors:
-        if isGraphicAudio(author.name): 
-            continue
-        else:
-            for bauthor in book.authors:
-                if isGraphicAudio(bauthor.name): 
-                    continue
-                else:
-                    if verbose:
-                        print (f"Checking if {book.title} is {authors}'s book: {book.authors}")
-
-                    #print (f"Author: {author.name} = {bauthor.name}? {(author.name.replace(' ', '') == bauthor.name.replace(' ', ''))}")
-                    if (cleanseAuthor(author.name).replace(" ", "") == cleanseAuthor(bauthor.name).replace(" ", "")):
-                        #print ("found\n")
-                        found=True
-                        break
-        
-        if found: break
-
-    return found
+    if verbose:
+        print (f"Checking if {book.title} is {authors}'s book: {book.authors}")
+
+    #both sides are reduced to precomputed author identities, see myx_authors
+    return myx_authors.authorsMatch(authors, book.authors)
 
 def isThisMyBookTitle (title, book, cfg):
     #Config
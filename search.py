@@ -2,11 +2,15 @@ import httpx
 import re
 from dataclasses import dataclass, field
 from bs4 import BeautifulSoup
+import myx_utilities
+
+#Module variables
+search_engines={"goodreads": "https://www.goodreads.com","google": "https://www.google.com"}
 
 @dataclass
 class Search:
     headers: dict = field(default_factory=lambda: {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3"})
-    search_engines: dict = field(default_factory=lambda: {"goodreads": "https://www.goodreads.com","google": "https://www.google.com"})
+    search_engines: dict = field(default_factory=lambda: dict(search_engines))
     base_url: str = ""
     engine: str = ""
     search_endpoint: str = "/search?q="
@@ -15,6 +19,7 @@ class Search:
     isbn13_pattern: str = r'^\d{13}$'
     google_site_prefix: str = "site:"
     book_url: str = ""
+    cfg: dict = None
 
     def set_base_url(self):
         self.base_url = f"{self.search_engines.get(self.engine)}{self.search_endpoint}"
@@ -42,7 +47,7 @@ class Search:
                 # catch-all if only the title is available.
                 search_url = f"{self.base_url}{title}"
 
-            response = httpx.get(search_url, headers=self.headers)
+            response = myx_utilities.httpGet(httpx, self.cfg, "search", search_url, headers=self.headers)
             response.raise_for_status()
 
             # parse the resulting page of HTML that comprises the search page